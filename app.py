@@ -1,7 +1,16 @@
 import os
+import io
+import csv
+import json
+import heapq
+import asyncio
+import zipfile
+import tempfile
+import functools
 import logging
+from collections import OrderedDict
+from time import monotonic as time_monotonic
 from datetime import datetime, timedelta, timezone, time
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, BigInteger, func
 from telegram.helpers import escape_markdown
 import html
 from telegram import (
@@ -26,28 +35,51 @@ from telegram.ext import (
 )
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey
+    Column, Integer, String, DateTime, Boolean, ForeignKey, BigInteger, func, select, insert, delete,
+    case, literal, or_, and_, text
 )
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import update as sql_update   # "update" è già il nome dei parametri degli handler
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+from migrations import apply_migrations
+from dispatcher import OutboundRateLimiter, send_all
+from persistence import DBPersistence
+from outbox import OutboxWorker, ON_SENT_DIRECTORS_MESSAGE, enqueue as outbox_enqueue
+import metrics
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-booking_msg_map = {}
 
 # ---- ENV ----
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 PRIESTS_GROUP_ID = int(os.getenv("PRIESTS_GROUP_ID", "0"))
 DIRECTORS_GROUP_ID = int(os.getenv("DIRECTORS_GROUP_ID", "0"))
+# 🔹 Solo valori iniziali: al primo avvio popolano la tabella staff_roles (vedi RoleDirectory)
 SECRETARIES_IDS = {int(x) for x in os.getenv("SECRETARIES_IDS", "").split(",") if x}
 PRIESTS_IDS = {int(x) for x in os.getenv("PRIESTS_IDS", "").split(",") if x}
 DIRECTORS_IDS = {int(x) for x in os.getenv("DIRECTORS_IDS", "").split(",") if x}
 DIRECTORS_TOPIC_ID = int(os.getenv("DIRECTORS_TOPIC_ID"))
 # ---- DB ----
+def _async_database_url(url: str) -> str:
+    # 🔹 Forza il driver psycopg (v3) in modalità asincrona
+    for prefix in ("postgres://", "postgresql://", "postgresql+psycopg2://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine)
+engine = create_async_engine(
+    _async_database_url(DATABASE_URL),
+    pool_pre_ping=True,
+    poolclass=metrics.TimedQueuePool,   # 🔹 misura l'attesa per una connessione (vedi /metrics)
+)
+metrics.instrument_engine(engine)
+# expire_on_commit=False: gli oggetti restano leggibili dopo il commit senza altre query
+SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
 
 SACRAMENTS = [
     "battesimo",
@@ -81,8 +113,13 @@ class Booking(Base):
     notes = Column(String)
     status = Column(String, nullable=False, default="pending")
     secretary_username = Column(String, nullable=True)   # 👈 solo colonna
+    directors_message_id = Column(BigInteger, nullable=True)   # 👈 messaggio con "➕ Assegna"
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    deleted_at = Column(DateTime, nullable=True)   # 👈 rimozione logica: la storia resta per i report
+
+# 🔹 Condizione comune a liste, cruscotti e avvisi: le prenotazioni rimosse non si vedono più
+BOOKING_NOT_DELETED = Booking.deleted_at.is_(None)
 
 class Assignment(Base):
     __tablename__ = "assignments"
@@ -110,21 +147,380 @@ class Priest(Base):
     username = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-def init_db():
-    Base.metadata.create_all(engine)
+class PriestWorkload(Base):
+    # 🔹 Contatori per sacerdote e settimana ISO, aggiornati insieme ad assegnazioni e completamenti
+    __tablename__ = "priest_workload"
+    priest_telegram_id = Column(BigInteger, primary_key=True)
+    iso_year = Column(Integer, primary_key=True)
+    iso_week = Column(Integer, primary_key=True)
+    assigned_count = Column(Integer, nullable=False, default=0, server_default="0")
+    completed_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+class StaffRole(Base):
+    # 🔹 Ruoli dello staff (una riga per utente e ruolo), modificabili con i comandi della Direzione
+    __tablename__ = "staff_roles"
+    telegram_id = Column(BigInteger, primary_key=True)
+    role = Column(String, primary_key=True)
+    added_by = Column(BigInteger, nullable=True)
+    added_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+class DirectoryVersion(Base):
+    # 🔹 Contatore incrementato a ogni modifica: gli altri worker ricaricano solo se cambia
+    __tablename__ = "directory_versions"
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+class BotSetting(Base):
+    # 🔹 Impostazioni modificabili dalla Direzione (es. assegnazione automatica)
+    __tablename__ = "bot_settings"
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+    updated_by = Column(BigInteger, nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+async def init_db(application=None):
+    # 🔹 Schema e indici gestiti dalle migrazioni versionate (vedi migrations.py)
+    await apply_migrations(engine, Base.metadata)
+
+# ---- DIRECTORY SACERDOTI ----
+class PriestDirectory:
+    # 🔹 Copia in memoria della tabella priests (cambia raramente), indicizzata per telegram_id.
+    #    Caricata una volta, aggiornata da start() e ricaricata dopo PRIEST_DIRECTORY_TTL
+    #    per allinearsi alle modifiche fatte da altri worker.
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._by_id = {}
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def _fresh(self):
+        return self._loaded_at is not None and time_monotonic() - self._loaded_at < self._ttl
+
+    async def _ensure_loaded(self):
+        if self._fresh():
+            return
+        async with self._lock:
+            if self._fresh():
+                return
+            session = SessionLocal()
+            try:
+                priests = (await session.scalars(select(Priest).order_by(Priest.id))).all()
+            finally:
+                await session.close()
+            self._by_id = {p.telegram_id: p for p in priests}
+            self._loaded_at = time_monotonic()
+
+    async def all(self):
+        await self._ensure_loaded()
+        return list(self._by_id.values())
+
+    async def get(self, telegram_id):
+        await self._ensure_loaded()
+        return self._by_id.get(telegram_id)
+
+    async def get_many(self, telegram_ids):
+        await self._ensure_loaded()
+        return {tid: self._by_id[tid] for tid in telegram_ids if tid in self._by_id}
+
+    async def tag(self, telegram_id):
+        priest = await self.get(telegram_id)
+        return _priest_tag(priest) if priest else str(telegram_id)
+
+    def put(self, priest):
+        # Aggiorna una voce senza ricaricare tutto (solo se la directory è già in memoria)
+        if self._loaded_at is not None:
+            self._by_id[priest.telegram_id] = priest
+
+    def invalidate(self):
+        self._loaded_at = None
+
+
+def _priest_tag(priest):
+    # 🔹 Chi è stato aggiunto con /aggiungi_ruolo non ha ancora uno username (arriva al primo /start)
+    return f"@{priest.username}" if priest.username else str(priest.telegram_id)
+
+
+PRIEST_DIRECTORY_TTL = 10 * 60   # secondi
+priest_directory = PriestDirectory(PRIEST_DIRECTORY_TTL)
+
+# ---- RUOLI STAFF ----
+ROLE_PRIEST = "sacerdote"
+ROLE_SECRETARY = "segretario"
+ROLE_DIRECTOR = "direzione"
+ROLES = (ROLE_PRIEST, ROLE_SECRETARY, ROLE_DIRECTOR)
+ROLES_VERSION_KEY = "roles"
+
+async def _bump_directory_version(session, name):
+    # 🔹 Nella transazione del chiamante: la modifica e il nuovo numero di versione sono atomici
+    stmt = pg_insert(DirectoryVersion).values(name=name, version=1)
+    return await session.scalar(stmt.on_conflict_do_update(
+        index_elements=[DirectoryVersion.name],
+        set_={"version": DirectoryVersion.version + 1},
+    ).returning(DirectoryVersion.version))
+
+class RoleDirectory:
+    # 🔹 Tabella staff_roles tenuta in memoria come un set di ID per ruolo: is_priest / is_secretary /
+    #    is_director restano controlli O(1) e sincroni. Ogni ROLE_CHECK_INTERVAL secondi un task legge
+    #    solo il numero di versione e ricarica i ruoli se un altro worker li ha modificati.
+    #    Al primo avvio (tabella vuota) i ruoli vengono presi dalle variabili d'ambiente.
+    def __init__(self, check_interval, seed):
+        self._check_interval = check_interval
+        self._seed = seed
+        self._members = {role: frozenset() for role in ROLES}
+        self._version = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def has(self, role, user_id):
+        return user_id in self._members[role]
+
+    def members(self, role):
+        return self._members[role]
+
+    async def _reload(self, session):
+        version = await session.scalar(
+            select(DirectoryVersion.version).where(DirectoryVersion.name == ROLES_VERSION_KEY)
+        )
+        members = {role: set() for role in ROLES}
+        for telegram_id, role in (await session.execute(select(StaffRole.telegram_id, StaffRole.role))).all():
+            if role in members:
+                members[role].add(telegram_id)
+        # Sostituzione in un colpo solo: chi legge vede sempre un insieme coerente
+        self._members = {role: frozenset(ids) for role, ids in members.items()}
+        self._version = version or 0
+
+    async def load(self):
+        async with self._lock:
+            session = SessionLocal()
+            try:
+                rows = [
+                    {"telegram_id": tid, "role": role}
+                    for role, ids in self._seed.items() for tid in ids
+                ]
+                if rows and await session.scalar(select(StaffRole.telegram_id).limit(1)) is None:
+                    await session.execute(pg_insert(StaffRole).values(rows).on_conflict_do_nothing())
+                    await _bump_directory_version(session, ROLES_VERSION_KEY)
+                    await session.commit()
+                    logger.info("Ruoli staff inizializzati dall'ambiente (%s voci)", len(rows))
+                await self._reload(session)
+            finally:
+                await session.close()
+
+    async def refresh(self):
+        # 🔹 Controllo economico: una riga letta per chiave primaria
+        session = SessionLocal()
+        try:
+            version = await session.scalar(
+                select(DirectoryVersion.version).where(DirectoryVersion.name == ROLES_VERSION_KEY)
+            )
+            if (version or 0) != self._version:
+                async with self._lock:
+                    await self._reload(session)
+        finally:
+            await session.close()
+
+    async def add(self, telegram_id, role, actor_id):
+        async with self._lock:
+            session = SessionLocal()
+            try:
+                added = await session.scalar(
+                    pg_insert(StaffRole)
+                    .values(telegram_id=telegram_id, role=role, added_by=actor_id)
+                    .on_conflict_do_nothing()
+                    .returning(StaffRole.telegram_id)
+                )
+                if added is not None:
+                    if role == ROLE_PRIEST:
+                        # Subito selezionabile nei menu, senza aspettare il suo /start
+                        await session.execute(
+                            pg_insert(Priest)
+                            .values(telegram_id=telegram_id, created_at=datetime.now())
+                            .on_conflict_do_nothing(index_elements=[Priest.telegram_id])
+                        )
+                    await _bump_directory_version(session, ROLES_VERSION_KEY)
+                    await session.commit()
+                await self._reload(session)
+            finally:
+                await session.close()
+        if added is not None and role == ROLE_PRIEST:
+            priest_directory.invalidate()
+        return added is not None
+
+    async def remove(self, telegram_id, role):
+        async with self._lock:
+            session = SessionLocal()
+            try:
+                removed = await session.scalar(
+                    delete(StaffRole)
+                    .where(StaffRole.telegram_id == telegram_id, StaffRole.role == role)
+                    .returning(StaffRole.telegram_id)
+                )
+                if removed is not None:
+                    await _bump_directory_version(session, ROLES_VERSION_KEY)
+                    await session.commit()
+                await self._reload(session)
+            finally:
+                await session.close()
+        return removed is not None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._check_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Aggiornamento ruoli staff fallito, nuovo tentativo al prossimo giro")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+ROLE_CHECK_INTERVAL = 30   # secondi
+role_directory = RoleDirectory(ROLE_CHECK_INTERVAL, {
+    ROLE_PRIEST: PRIESTS_IDS,
+    ROLE_SECRETARY: SECRETARIES_IDS,
+    ROLE_DIRECTOR: DIRECTORS_IDS,
+})
+
+# ---- STORICO EVENTI ----
+class EventLogQueue:
+    # 🔹 Gli handler accodano gli eventi in memoria (nessun commit in più per azione);
+    #    un task li scrive con un unico INSERT multi-riga ogni EVENT_LOG_FLUSH_INTERVAL
+    #    secondi o appena la coda raggiunge EVENT_LOG_BATCH. stop() svuota la coda allo spegnimento.
+    def __init__(self, flush_interval, batch_size):
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def log(self, booking_id, actor_id, action, details=""):
+        self.log_many([booking_id], actor_id, action, details)
+
+    def log_many(self, booking_ids, actor_id, action, details=""):
+        now = datetime.now(timezone.utc)
+        self._pending.extend(
+            {"booking_id": bid, "actor_id": actor_id, "action": action, "ts": now, "details": details}
+            for bid in booking_ids
+        )
+        if len(self._pending) >= self._batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                async with engine.begin() as conn:
+                    await conn.execute(insert(EventLog), batch)
+            except Exception:
+                # Nessun evento perso: torna in testa alla coda per il prossimo giro
+                logger.exception("Scrittura storico eventi fallita (%s eventi), nuovo tentativo", len(batch))
+                self._pending[:0] = batch
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+EVENT_LOG_FLUSH_INTERVAL = 2   # secondi
+EVENT_LOG_BATCH = 500
+event_log = EventLogQueue(EVENT_LOG_FLUSH_INTERVAL, EVENT_LOG_BATCH)
+
+# ---- NOTIFICHE ----
+# 🔹 Le notifiche ai sacerdoti e alla Direzione vengono scritte nella tabella outbox
+#    insieme al cambio di stato; il worker le invia, ritenta e le deduplica (vedi outbox.py)
+outbox = OutboxWorker(engine)
+
+async def on_startup(application):
+    await init_db()
+    # 🔹 Ruoli in memoria prima del primo update
+    await role_directory.load()
+    role_directory.start()
+    event_log.start()
+    outbox.start(application.bot)
+
+async def on_shutdown(application):
+    # 🔹 Gli eventi ancora in coda vengono scritti prima di chiudere
+    await event_log.stop()
+    # Le notifiche non inviate restano nella outbox e ripartono al prossimo avvio
+    await outbox.stop()
+    await role_directory.stop()
+
+# ---- CARICO SETTIMANALE ----
+async def _bump_workload(session, priest_id, when, assigned=0, completed=0):
+    # 🔹 Upsert del contatore della settimana ISO di "when" (nella transazione del chiamante)
+    iso_year, iso_week, _ = when.isocalendar()
+    stmt = pg_insert(PriestWorkload).values(
+        priest_telegram_id=priest_id,
+        iso_year=iso_year,
+        iso_week=iso_week,
+        assigned_count=max(assigned, 0),
+        completed_count=max(completed, 0),
+    )
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[PriestWorkload.priest_telegram_id, PriestWorkload.iso_year, PriestWorkload.iso_week],
+        set_={
+            "assigned_count": func.greatest(PriestWorkload.assigned_count + assigned, 0),
+            "completed_count": func.greatest(PriestWorkload.completed_count + completed, 0),
+        },
+    ))
+
+async def _weekly_assigned_counts(session, when):
+    iso_year, iso_week, _ = when.isocalendar()
+    rows = (await session.execute(
+        select(PriestWorkload.priest_telegram_id, PriestWorkload.assigned_count)
+        .where(PriestWorkload.iso_year == iso_year, PriestWorkload.iso_week == iso_week)
+    )).all()
+    return {pid: cnt for pid, cnt in rows}
 
 # ---- UTILS ----
 def is_secretary(user_id: int) -> bool:
-    return user_id in SECRETARIES_IDS
+    return role_directory.has(ROLE_SECRETARY, user_id)
 
 def is_priest(user_id: int) -> bool:
-    return user_id in PRIESTS_IDS
+    return role_directory.has(ROLE_PRIEST, user_id)
 
 def is_director(user_id: int) -> bool:
-    return user_id in DIRECTORS_IDS
+    return role_directory.has(ROLE_DIRECTOR, user_id)
+
+async def _active_priests():
+    # 🔹 La tabella priests conserva anche chi ha perso il ruolo: nei menu solo i sacerdoti attuali
+    return [p for p in await priest_directory.all() if is_priest(p.telegram_id)]
 
 def role_required(check_func, msg="**𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄** ⚓️\n\n❌ Hey, sembra che tu non abbia il permesso per effettuare questo comando.\n\nSe pensi sia un errore contatta 👉 @LavatiScimmiaInfuocata"):
     def decorator(func):
+        @functools.wraps(func)   # conserva il nome dell'handler (etichetta delle metriche)
         async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id = update.effective_user.id
             if not check_func(user_id):
@@ -134,6 +530,94 @@ def role_required(check_func, msg="**𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒
         return wrapper
     return decorator
 
+# ---- SCHEDE PRENOTAZIONE ----
+CARD_PANEL = "panel"        # pannello Direzione (/lista_prenotazioni)
+CARD_PRIEST = "priest"      # cruscotto sacerdote (/mie_assegnazioni)
+CARD_SUMMARY = "summary"    # resoconto di ig_confirm (segretario e Direzione)
+
+BOOKING_CARD_CACHE_SIZE = 2000
+BOOKING_CARD_LOOKUPS = metrics.Counter(
+    "booking_card_cache_total", "Schede prenotazione servite dalla cache o ricalcolate", ("view", "result")
+)
+
+def _booking_fields(b):
+    # 🔹 Campi comuni a tutte le schede, già pronti per parse_mode="HTML"
+    return {
+        "sacrament": html.escape((b.sacrament or "").replace("_", " ")),
+        "nick": html.escape(b.nickname_mc) if b.nickname_mc else None,
+        "contact": html.escape(b.rp_name) if b.rp_name else None,
+        "notes": html.escape(b.notes) if b.notes else None,
+    }
+
+def _format_booking_card(b, view):
+    f = _booking_fields(b)
+    if view == CARD_PANEL:
+        secretary_tag = f"@{html.escape(b.secretary_username)}" if b.secretary_username else "Nessun contatto presente."
+        timestamp = b.created_at.strftime("%d/%m/%Y %H:%M") if b.created_at else "-"
+        return (
+            f"📌 Prenotazione #{b.id} [{b.status.upper()}]\n"
+            f"• ✝️ Sacramento/i: {f['sacrament']}\n"
+            f"• 🎮 Nick Minecraft: {f['nick'] or 'Nessun nickname inserito.'}\n"
+            f"• 👤 Contatto TG fedele: {f['contact'] or 'Nessun contatto inserito.'}\n"
+            f"• 📝 Note: {f['notes'] or 'Nessuna nota.'}\n"
+            f"• 📖 Registrata dal segretario: {secretary_tag}\n"
+            f"• ⏰ Orario: {timestamp}\n"
+        )
+    if view == CARD_PRIEST:
+        if b.status == "assigned":
+            header = f"⚠️ <b>#{b.id} [DA COMPLETARE]</b> - {f['sacrament']}"
+        else:
+            header = f"✅ #{b.id} [{b.status.upper()}] - {f['sacrament']}"
+        return (
+            f"{header}\n"
+            f"👤 Contatto TG: {f['contact'] or 'Nessun contatto presente.'}\n"
+            f"🎮 Nick: {f['nick'] or 'Nessun nickname inserito.'}\n"
+            f"📝 Note: {f['notes'] or 'Nessuna nota.'}"
+        )
+    if view == CARD_SUMMARY:
+        notes = f["notes"] or "nessuna nota presente."
+        if b.sacrament == "divorzio":
+            return (
+                f"• 🎮 Nick: <b>{f['nick'] or ''}</b>\n"
+                f"• 💔 Divorzio registrato\n"
+                f"• 📝 Motivo: <b>{notes}</b>"
+            )
+        return (
+            f"• 👤 Contatto Telegram: <b>{f['contact'] or ''}</b>\n"
+            f"• 🎮 Nick: <b>{f['nick'] or ''}</b>\n"
+            f"• ✝️ Sacramenti: <b>{f['sacrament']}</b>\n"
+            f"• 📝 Note: <b>{notes}</b>"
+        )
+    raise ValueError(view)
+
+class BookingCardCache:
+    # 🔹 LRU delle schede già formattate, per vista: la chiave include updated_at, quindi
+    #    una prenotazione modificata (assegnata, riassegnata, completata) genera una voce nuova
+    #    e quella vecchia esce per anzianità. Sfogliare le pagine non riformatta nulla.
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._cards = OrderedDict()
+
+    def render(self, booking, view):
+        key = (view, booking.id, booking.updated_at)
+        card = self._cards.get(key)
+        if card is not None:
+            self._cards.move_to_end(key)
+            BOOKING_CARD_LOOKUPS.inc(view, "hit")
+            return card
+        BOOKING_CARD_LOOKUPS.inc(view, "miss")
+        card = _format_booking_card(booking, view)
+        self._cards[key] = card
+        if len(self._cards) > self._max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    def clear(self):
+        self._cards.clear()
+
+booking_cards = BookingCardCache(BOOKING_CARD_CACHE_SIZE)
+render_booking_card = booking_cards.render
+
 # ---- CONVERSATION STATES ----
 IG_RP_NAME, IG_NICK, IG_SACRAMENT, IG_NOTES, IG_CONFIRM = range(5)
 
@@ -148,7 +632,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_priest(user_id):
         session = SessionLocal()
         try:
-            priest = session.query(Priest).filter_by(telegram_id=user_id).first()
+            priest = await session.scalar(select(Priest).filter_by(telegram_id=user_id))
             if priest:
                 # Aggiorna username se è cambiato
                 if priest.username != user.username:
@@ -162,12 +646,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     created_at=datetime.now()
                 )
                 session.add(priest)
-            session.commit()
+            await session.commit()
+            # 🔹 Tiene allineata la directory in memoria (username nuovo o sacerdote nuovo)
+            priest_directory.put(priest)
         except Exception:
-            session.rollback()
+            await session.rollback()
             raise
         finally:
-            session.close()
+            await session.close()
         roles.append("sacerdote")
 
     if is_secretary(user_id):
@@ -219,7 +705,7 @@ async def _send_role_welcome(target_message: Message, role: str):
         )
     elif role == "direzione":
         await target_message.reply_text(
-            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n👑 Benvenuto! Questo bot ti aiuterà nelle tue mansioni da <b>Patriarca</b>.\n\n📜 Comandi principali:\n- <code>/assegna &lt;id prenotazione&gt; &lt;@sacerdote&gt;</code> → assegna una prenotazione a un sacerdote.\n- <code>/riassegna &lt;id prenotazione&gt; &lt;@sacerdote&gt;</code> → riassegna una prenotazione già assegnata.\n- <code>/lista_prenotazioni</code> → consulta le prenotazioni filtrate:\n   • ⏳ <b>pending</b> → prenotazioni in attesa\n   • 📌 <b>assigned</b> → prenotazioni assegnate\n   • ✅ <b>completed</b> → prenotazioni completate\n   • 👤 <b>@sacerdote</b> → prenotazioni di un sacerdote\n   • 🎮 <b>nick fedele</b> → prenotazioni di un fedele\n\nSe hai difficoltà o riscontri problemi contatta 👉 <b>Falco</b> o <b>yomino</b>.",
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n👑 Benvenuto! Questo bot ti aiuterà nelle tue mansioni da <b>Patriarca</b>.\n\n📜 Comandi principali:\n- <code>/assegna &lt;id prenotazione&gt; &lt;@sacerdote&gt;</code> → assegna una prenotazione a un sacerdote.\n- <code>/riassegna &lt;id prenotazione&gt; &lt;@sacerdote&gt;</code> → riassegna una prenotazione già assegnata.\n- <code>/lista_prenotazioni</code> → consulta le prenotazioni filtrate:\n   • ⏳ <b>pending</b> → prenotazioni in attesa\n   • 📌 <b>assigned</b> → prenotazioni assegnate\n   • ✅ <b>completed</b> → prenotazioni completate\n   • 👤 <b>@sacerdote</b> → prenotazioni di un sacerdote\n   • 🎮 <b>nick fedele</b> → prenotazioni di un fedele\n- <code>/auto_assegna</code> → attiva o disattiva l'assegnazione automatica al sacerdote meno carico.\n- <code>/ruoli</code> → consulta e modifica i ruoli dello staff (sacerdoti, segretari, Direzione).\n\nSe hai difficoltà o riscontri problemi contatta 👉 <b>Falco</b> o <b>yomino</b>.",
             parse_mode="HTML"
         )
     else:
@@ -530,76 +1016,69 @@ async def ig_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             secretary_username=user.username or f"ID:{user.id}"
         )
         session.add(booking)
-        session.commit()
-
-        session.add(EventLog(
-            booking_id=booking.id,
-            actor_id=user_id,
-            action="create",
-            details="ingame"
-        ))
-        session.commit()
+        await session.flush()   # 🔹 serve l'ID per testi e chiave della notifica
 
-        rp_name = html.escape(booking.rp_name)
-        nickname_mc = html.escape(booking.nickname_mc)
-        sacrament_display = html.escape(sacrament_display_raw.replace("_"," "))
-        safe_notes = html.escape(booking.notes) if booking.notes else "nessuna nota presente."
+        # 🔹 Stessa scheda per Direzione e segretario
+        summary = render_booking_card(booking, CARD_SUMMARY)
         secretary_tag = f"@{user.username}" if user.username else f"ID:{user.id}"
         secretary_tag_safe = html.escape(secretary_tag)
 
-        # 🔹 MESSAGGIO DI CONFERMA PER IL SEGRETARIO
-        if is_divorce:
-            await query.edit_message_text(
-                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-                f"📑 Il <b>divorzio</b> è stato <i>registrato correttamente</i>! (ID #{booking.id})\n\n"
-                "📋 Resoconto delle informazioni inserite:\n\n"
-                f"• 🎮 Nick: <b>{nickname_mc}</b>\n"
-                f"• 💔 Divorzio registrato\n"
-                f"• 📝 Motivo: <b>{safe_notes}</b>",
-                parse_mode="HTML"
-            )
-        else:
-            await query.edit_message_text(
-                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-                f"✅ La tua prenotazione è stata <i>registrata con successo</i>! (ID #{booking.id})\n\n"
-                "📋 Resoconto delle informazioni inserite:\n\n"
-                f"• 👤 Contatto Telegram: <b>{rp_name}</b>\n"
-                f"• 🎮 Nick: <b>{nickname_mc}</b>\n"
-                f"• ✝️ Sacramenti: <b>{sacrament_display}</b>\n"
-                f"• 📝 Note: <b>{safe_notes}</b>",
-                parse_mode="HTML"
+        # 🤖 ASSEGNAZIONE AUTOMATICA (se attiva) → al sacerdote meno carico, nella stessa transazione
+        auto_assigned = []
+        if not is_divorce and await _auto_assign_enabled(session):
+            auto_assigned = await _auto_assign(
+                session, [Booking.id == booking.id], user_id, f"booking:{booking.id}:auto"
             )
 
-        # 🔹 MESSAGGIO ALLA DIREZIONE
+        # 🔹 MESSAGGIO ALLA DIREZIONE (outbox: stessa transazione della prenotazione)
         if is_divorce:
             # 🔥 DIVORZIO → nessun tasto assegna, topic diverso
             timestamp = datetime.now().strftime("%d/%m/%Y %H:%M")
 
-            await context.bot.send_message(
-                DIRECTORS_GROUP_ID,
-                f"<b>📑 NUOVA REGISTRAZIONE DI DIVORZIO</b> (ID #{booking.id})\n\n"
-                f"• 🎮 Nick: <b>{nickname_mc}</b>\n"
-                f"• 💔 Divorzio registrato\n"
-                f"• 📝 Motivo: <b>{safe_notes}</b>\n"
+            await outbox_enqueue(
+                session,
+                f"booking:{booking.id}:directors",
+                "send_message",
+                chat_id=DIRECTORS_GROUP_ID,
+                text=f"<b>📑 NUOVA REGISTRAZIONE DI DIVORZIO</b> (ID #{booking.id})\n\n"
+                f"{summary}\n"
                 f"• 🕒 Registrato il: <b>{timestamp}</b>\n\n"
                 f"📌 Registrato dal segretario: <b>{secretary_tag_safe}</b>",
                 parse_mode="HTML",
                 message_thread_id=12973
             )
 
+        elif auto_assigned:
+            # 🤖 GIÀ ASSEGNATA → nessun tasto assegna
+            _, priest = auto_assigned[0]
+            await outbox_enqueue(
+                session,
+                f"booking:{booking.id}:directors",
+                "send_message",
+                chat_id=DIRECTORS_GROUP_ID,
+                text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n📢 È presente una nuova <b>prenotazione</b>! (ID #{booking.id})\n\n"
+                f"{summary}\n\n"
+                f"📌 Prenotazione registrata dal segretario: <b>{secretary_tag_safe}</b>\n\n"
+                f"🤖 Assegnata automaticamente a <b>{html.escape(await priest_directory.tag(priest.telegram_id))}</b>.",
+                parse_mode="HTML",
+                message_thread_id=DIRECTORS_TOPIC_ID
+            )
         else:
             # 🔥 PRENOTAZIONE NORMALE → tasto assegna + topic normale
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("➕ Assegna", callback_data=f"assign_{booking.id}")]
             ])
 
-            msg = await context.bot.send_message(
-                DIRECTORS_GROUP_ID,
-                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n📢 È presente una nuova <b>prenotazione</b>! (ID #{booking.id})\n\n"
-                f"• 👤 Contatto Telegram: <b>{rp_name}</b>\n"
-                f"• 🎮 Nick: <b>{nickname_mc}</b>\n"
-                f"• ✝️ Sacramenti: <b>{sacrament_display}</b>\n"
-                f"• 📝 Note: <b>{safe_notes}</b>\n\n"
+            # 🔹 L'ID del messaggio lo salva il worker sulla prenotazione (serve a do_assign_callback)
+            await outbox_enqueue(
+                session,
+                f"booking:{booking.id}:directors",
+                "send_message",
+                booking_id=booking.id,
+                on_sent=ON_SENT_DIRECTORS_MESSAGE,
+                chat_id=DIRECTORS_GROUP_ID,
+                text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n📢 È presente una nuova <b>prenotazione</b>! (ID #{booking.id})\n\n"
+                f"{summary}\n\n"
                 f"📌 Prenotazione registrata dal segretario: <b>{secretary_tag_safe}</b>\n\n"
                 "⚠️ Ricorda di verificare i campi inseriti e di assegnarla il prima possibile a un sacerdote.",
                 reply_markup=kb,
@@ -607,7 +1086,30 @@ async def ig_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 message_thread_id=DIRECTORS_TOPIC_ID
             )
 
-            booking_msg_map[booking.id] = msg.message_id
+        await session.commit()
+        outbox.notify()
+        event_log.log(booking.id, user_id, "create", "ingame")
+        _log_auto_assign(auto_assigned, user_id)
+
+        # 🔹 MESSAGGIO DI CONFERMA PER IL SEGRETARIO
+        if is_divorce:
+            confirm_call = query.edit_message_text(
+                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                f"📑 Il <b>divorzio</b> è stato <i>registrato correttamente</i>! (ID #{booking.id})\n\n"
+                "📋 Resoconto delle informazioni inserite:\n\n"
+                f"{summary}",
+                parse_mode="HTML"
+            )
+        else:
+            confirm_call = query.edit_message_text(
+                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                f"✅ La tua prenotazione è stata <i>registrata con successo</i>! (ID #{booking.id})\n\n"
+                "📋 Resoconto delle informazioni inserite:\n\n"
+                f"{summary}",
+                parse_mode="HTML"
+            )
+        # 🔹 Un errore di Telegram qui non annulla la prenotazione (già salvata)
+        await send_all(confirm_call)
 
         # 🔥 Sblocca la procedura /prenota_ingame
         context.user_data.pop("ingame_active", None)
@@ -615,7 +1117,7 @@ async def ig_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     finally:
-        session.close()
+        await session.close()
 
 
 # ---- DIREZIONE: CALLBACK "Assegna" ----
@@ -656,25 +1158,15 @@ async def assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     session = SessionLocal()
     try:
-        booking = session.query(Booking).get(booking_id)
-        if not booking or booking.status != "pending":
+        booking = await session.get(Booking, booking_id)
+        if not booking or booking.deleted_at or booking.status != "pending":
             await query.answer("⚠️ Prenotazione non valida o già assegnata.", show_alert=True)
             return
-        # 🔹 Calcolo settimana corrente (lunedì ➝ domenica)
-        now = datetime.now(timezone.utc)
-        start_week = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
-        end_week = start_week + timedelta(days=6, hours=23, minutes=59, seconds=59)
-
-        assigns_week = (
-            session.query(Assignment.priest_telegram_id, func.count(Assignment.id))
-            .join(Booking, Booking.id == Assignment.booking_id)
-            .filter(Booking.updated_at >= start_week, Booking.updated_at <= end_week)
-            .group_by(Assignment.priest_telegram_id)
-            .all()
-        )
-        counts = {pid: cnt for pid, cnt in assigns_week}
+        # 🔹 Assegnazioni della settimana ISO corrente, lette dai contatori (poche righe)
+        counts = await _weekly_assigned_counts(session, datetime.now(timezone.utc))
 
-        all_priests = session.query(Priest).all()
+        # 🔹 Solo chi ha ancora il ruolo di sacerdote (i ruoli rimossi spariscono dal menu)
+        all_priests = await _active_priests()
 
         real_priests = [
             p for p in all_priests
@@ -693,21 +1185,21 @@ async def assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 🔹 Costruisci bottoni SOLO per sacerdoti e segretari
         selectable = real_priests + secretaries
         buttons = [
-            [InlineKeyboardButton(f"@{p.username}", callback_data=f"do_assign_{booking_id}_{p.telegram_id}")]
+            [InlineKeyboardButton(_priest_tag(p), callback_data=f"do_assign_{booking_id}_{p.telegram_id}")]
             for p in selectable
         ]
         buttons.append([InlineKeyboardButton("❌ Annulla", callback_data="cancel_assign")])
 
         # 🔹 Testo suggerimento sacerdoti
         priest_lines = [
-            f"- @{p.username}: {counts.get(p.telegram_id, 0)} assegnazioni"
+            f"- {_priest_tag(p)}: {counts.get(p.telegram_id, 0)} assegnazioni"
             for p in top3
         ]
         priest_text = "\n".join(priest_lines) if priest_lines else "ℹ️ Nessun sacerdote disponibile."
 
         # 🔹 Testo riepilogo segretari (esclusi direttori)
         secretary_lines = [
-            f"- @{s.username}: {counts.get(s.telegram_id, 0)} assegnazioni"
+            f"- {_priest_tag(s)}: {counts.get(s.telegram_id, 0)} assegnazioni"
             for s in secretaries
         ]
         secretary_text = "\n".join(secretary_lines) if secretary_lines else "ℹ️ Nessun segretario registrato."
@@ -726,13 +1218,12 @@ async def assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["assign_msg_id"] = msg.message_id
         context.user_data["assign_booking_id"] = booking.id
     finally:
-        session.close()
+        await session.close()
 
 
 # ---- DIREZIONE: CALLBACK scelta sacerdote ----
 async def do_assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     # Rimuovi il prefisso "do_assign_"
     data = query.data.replace("do_assign_", "")
     booking_id, priest_id = data.split("_")
@@ -740,17 +1231,26 @@ async def do_assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     priest_id = int(priest_id)
     session = SessionLocal()
     try:
-        booking = session.query(Booking).get(booking_id)
-        priest = session.query(Priest).filter(Priest.telegram_id == priest_id).first()
+        # 🔒 Riga bloccata fino al commit: un secondo click (o un altro direttore) attende
+        #    e poi trova la prenotazione già assegnata, senza doppia Assignment né doppio contatore
+        booking = (await session.execute(
+            select(Booking).where(Booking.id == booking_id).with_for_update()
+        )).scalar_one_or_none()
+        if not booking or booking.deleted_at or booking.status != "pending":
+            await query.answer("⚠️ Prenotazione non valida o già assegnata.", show_alert=True)
+            return
 
-        if not booking or not priest:
-            await query.answer("❌ Errore: prenotazione o sacerdote non trovati.", show_alert=True)
+        priest = await priest_directory.get(priest_id)
+        if not priest:
+            await query.answer("❌ Errore: sacerdote non trovato.", show_alert=True)
             return
 
         # 🔹 Aggiorna stato prenotazione
+        now = datetime.now(timezone.utc)
         booking.status = "assigned"
-        booking.updated_at = datetime.now(timezone.utc)
+        booking.updated_at = now
         session.add(booking)
+        await _bump_workload(session, priest.telegram_id, now, assigned=1)
 
         assign = Assignment(
             booking_id=booking.id,
@@ -759,50 +1259,49 @@ async def do_assign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             assigned_by=update.effective_user.id,
         )
         session.add(assign)
-        session.add(EventLog(
-            booking_id=booking.id,
-            actor_id=update.effective_user.id,
-            action="assign",
-            details=f"to @{priest.username}"
-        ))
-        session.commit()
+        await session.flush()   # 🔹 l'ID dell'assegnazione rende unica la chiave delle notifiche
 
+        # 🔹 Notifiche nella outbox, nella stessa transazione dell'assegnazione:
+        #    le invia il worker (con nuovi tentativi), l'handler non le aspetta
+        key = f"assign:{assign.id}"
         # 🔹 Elimina messaggio con lista sacerdoti
         assign_msg_id = context.user_data.get("assign_msg_id")
         if assign_msg_id:
-            await context.bot.delete_message(DIRECTORS_GROUP_ID, assign_msg_id)
-        # 🔹 Rimuovi pulsante "Assegna" dal messaggio originale (usando mappa globale)
-        booking_msg_id = booking_msg_map.get(booking.id)
+            await outbox_enqueue(
+                session, f"{key}:picker", "delete_message",
+                chat_id=DIRECTORS_GROUP_ID, message_id=assign_msg_id
+            )
+        # 🔹 Rimuovi pulsante "Assegna" dal messaggio originale (ID salvato sulla prenotazione)
+        booking_msg_id = booking.directors_message_id
         if booking_msg_id:
-            await context.bot.edit_message_reply_markup(
+            await outbox_enqueue(
+                session, f"{key}:button", "edit_message_reply_markup",
                 chat_id=DIRECTORS_GROUP_ID,
                 message_id=booking_msg_id,
                 reply_markup=None   # 🔹 niente message_thread_id qui
             )
         # 🔹 Notifica al gruppo Direzione
-        await context.bot.send_message(
-            DIRECTORS_GROUP_ID,
-            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✅ Prenotazione #{booking.id} <b>assegnata</b> a @{priest.username}.",
+        await outbox_enqueue(
+            session, f"{key}:directors", "send_message",
+            chat_id=DIRECTORS_GROUP_ID,
+            text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✅ Prenotazione #{booking.id} <b>assegnata</b> a {_priest_tag(priest)}.",
             parse_mode="HTML",
             message_thread_id=DIRECTORS_TOPIC_ID
         )
-
         # 🔹 Notifica al sacerdote (qui NON serve il topic, va in chat privata)
-        await context.bot.send_message(
-            priest.telegram_id,
-            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🙏 Hey sacerdote! Ti è stata <b>assegnata una nuova prenotazione</b> (#{booking.id}).\n➡️ Utilizza <code>/mie_assegnazioni</code> per i dettagli.",
+        await outbox_enqueue(
+            session, f"{key}:priest", "send_message",
+            chat_id=priest.telegram_id,
+            text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🙏 Hey sacerdote! Ti è stata <b>assegnata una nuova prenotazione</b> (#{booking.id}).\n➡️ Utilizza <code>/mie_assegnazioni</code> per i dettagli.",
             parse_mode="HTML"
         )
-
-        # 🔹 Pianifica job di notifica 48h
-        context.job_queue.run_once(
-            notify_uncompleted,
-            when=48*3600,
-            data={"booking_id": booking.id, "priest_id": priest.telegram_id, "username": priest.username},
-            name=f"notify_{booking.id}"
-        )
+        await session.commit()
+        outbox.notify()
+        # Risposta solo a esito noto: gli avvisi sopra usano la stessa (unica) risposta al callback
+        await query.answer()
+        event_log.log(booking.id, update.effective_user.id, "assign", f"to {_priest_tag(priest)}")
     finally:
-        session.close()
+        await session.close()
 
 @role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
 async def riassegna(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -813,20 +1312,175 @@ async def riassegna(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    kb = _priests_keyboard(
+        await _active_priests(),
+        "reassign_choose_priest_",
+        extra_rows=[[InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")]],
+    )
+
+    await update.message.reply_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🙏 Scegli il sacerdote a cui vuoi riassegnare una prenotazione:",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
+
+REASSIGN_PER_PAGE = 5
+
+def _priests_keyboard(priests, callback_prefix, extra_rows=()):
+    buttons = [
+        [InlineKeyboardButton(_priest_tag(p), callback_data=f"{callback_prefix}{p.telegram_id}")]
+        for p in priests
+    ]
+    buttons.extend(extra_rows)
+    return InlineKeyboardMarkup(buttons)
+
+def _reassignable_criteria(to_priest_id, from_priest_id=0):
+    # 🔹 Prenotazioni assegnate ad altri (facoltativo: solo a un sacerdote di partenza).
+    #    Usa ix_bookings_live_status_id e ix_assignments_priest_booking
+    criteria = [
+        Booking.status == "assigned",
+        BOOKING_NOT_DELETED,
+        Assignment.priest_telegram_id != to_priest_id,
+    ]
+    if from_priest_id:
+        criteria.append(Assignment.priest_telegram_id == from_priest_id)
+    return criteria
+
+async def _reassign_bookings(session, criteria, to_priest_id, username, actor_id):
+    # 🔹 Sposta in blocco le assegnazioni che soddisfano "criteria" (nella transazione del chiamante):
+    #    righe bloccate, contatori settimanali, assegnazioni e prenotazioni con query fisse
+    rows = (await session.execute(
+        select(Assignment.id, Assignment.booking_id, Assignment.priest_telegram_id, Assignment.assigned_at)
+        .join(Booking, Booking.id == Assignment.booking_id)
+        .where(*criteria)
+        .order_by(Assignment.booking_id)
+        .with_for_update(of=Assignment)
+    )).all()
+    if not rows:
+        return []
+
+    now = datetime.now(timezone.utc)
+    # Il carico passa dal vecchio al nuovo sacerdote (settimana della vecchia assegnazione)
+    moved_out = {}
+    moved_in = 0
+    for _, _, old_priest, assigned_at in rows:
+        if old_priest == to_priest_id:
+            continue
+        moved_in += 1
+        if old_priest and assigned_at:
+            week = (old_priest,) + tuple(assigned_at.isocalendar()[:2])
+            count, _ = moved_out.get(week, (0, assigned_at))
+            moved_out[week] = (count + 1, assigned_at)
+    for (old_priest, _, _), (count, when) in moved_out.items():
+        await _bump_workload(session, old_priest, when, assigned=-count)
+    if moved_in:
+        await _bump_workload(session, to_priest_id, now, assigned=moved_in)
+
+    booking_ids = [r.booking_id for r in rows]
+    await session.execute(
+        sql_update(Assignment)
+        .where(Assignment.id.in_([r.id for r in rows]))
+        .values(
+            priest_telegram_id=to_priest_id,
+            priest_username=username,
+            assigned_by=actor_id,
+            # 🔹 Riparte il conteggio delle 48h (lo controlla sweep_uncompleted)
+            assigned_at=now,
+            due_alert_sent=False,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        sql_update(Booking)
+        .where(Booking.id.in_(booking_ids))
+        .values(updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    # Lo storico ("reassign") lo accoda il chiamante dopo il commit
+    return booking_ids
+
+async def _show_reassign_sources(query, to_priest_id):
+    # 🔹 Da chi prendere le prenotazioni: tutte oppure solo quelle di un sacerdote
+    priests = [p for p in await _active_priests() if p.telegram_id != to_priest_id]
+    to_tag = await priest_directory.tag(to_priest_id)
+    kb = _priests_keyboard(
+        priests,
+        f"reassign_list_{to_priest_id}_",
+        extra_rows=[
+            [InlineKeyboardButton("📋 Tutte le prenotazioni assegnate", callback_data=f"reassign_list_{to_priest_id}_0")],
+            [InlineKeyboardButton("⬅️ Indietro", callback_data="reassign_back_to_priests")],
+            [InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")],
+        ],
+    )
+    await query.edit_message_text(
+        f"<b>🔄 Riassegna a {html.escape(to_tag)}</b>\n\nDa quale sacerdote vuoi spostare le prenotazioni?",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
+
+async def _show_reassign_page(query, to_priest_id, from_priest_id, cursor=None):
+    # 🔹 Keyset su Booking.id DESC: il cursore ("n<id>" avanti, "p<id>" indietro) viaggia nel bottone
+    criteria = _reassignable_criteria(to_priest_id, from_priest_id)
+    stmt = (
+        select(Booking.id)
+        .join(Assignment, Assignment.booking_id == Booking.id)
+        .where(*criteria)
+    )
+    forward = True
+    if cursor:
+        forward, cursor_id = cursor[0] == "n", int(cursor[1:])
+        stmt = stmt.where(Booking.id < cursor_id if forward else Booking.id > cursor_id)
+    stmt = stmt.order_by(Booking.id.desc() if forward else Booking.id.asc()).limit(REASSIGN_PER_PAGE + 1)
+
     session = SessionLocal()
     try:
-        priests = session.query(Priest).all()
+        ids = list((await session.scalars(stmt)).all())
+        total = None
+        if from_priest_id and not cursor:
+            total = await session.scalar(
+                select(func.count(Booking.id)).join(Assignment, Assignment.booking_id == Booking.id).where(*criteria)
+            )
     finally:
-        session.close()
+        await session.close()
+
+    more = len(ids) > REASSIGN_PER_PAGE
+    ids = ids[:REASSIGN_PER_PAGE]
+    if forward:
+        has_prev, has_next = bool(cursor), more
+    else:
+        ids.reverse()
+        has_prev, has_next = more, True
+
+    back_row = [InlineKeyboardButton("⬅️ Indietro", callback_data=f"reassign_choose_priest_{to_priest_id}")]
+    if not ids:
+        await query.edit_message_text(
+            "<b>❌ Non ci sono prenotazioni assegnate da riassegnare.</b>",
+            reply_markup=InlineKeyboardMarkup([back_row]),
+            parse_mode="HTML"
+        )
+        return
 
+    prefix = f"reassign_list_{to_priest_id}_{from_priest_id}"
     buttons = [
-        [InlineKeyboardButton(f"@{p.username}", callback_data=f"reassign_choose_priest_{p.telegram_id}")]
-        for p in priests
+        [InlineKeyboardButton(f"Prenotazione #{bid}", callback_data=f"reassign_choose_booking_{to_priest_id}_{bid}")]
+        for bid in ids
     ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}_p{ids[0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}_n{ids[-1]}"))
+    if nav:
+        buttons.append(nav)
+    # 🔹 Tutto il carico di un sacerdote in un colpo solo (es. sacerdote inattivo)
+    if from_priest_id:
+        label = f"🔁 Riassegna tutte ({total})" if total is not None else "🔁 Riassegna tutte"
+        buttons.append([InlineKeyboardButton(label, callback_data=f"reassign_all_{to_priest_id}_{from_priest_id}")])
+    buttons.append(back_row)
     buttons.append([InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")])
 
-    await update.message.reply_text(
-        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🙏 Scegli il sacerdote a cui vuoi riassegnare una prenotazione:",
+    await query.edit_message_text(
+        "<b>📋 Seleziona la prenotazione da riassegnare:</b>",
         reply_markup=InlineKeyboardMarkup(buttons),
         parse_mode="HTML"
     )
@@ -843,209 +1497,461 @@ async def reassign_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 🔙 Torna alla lista sacerdoti
     if data == "reassign_back_to_priests":
-        session = SessionLocal()
-        try:
-            priests = session.query(Priest).all()
-        finally:
-            session.close()
-
-        buttons = [
-            [InlineKeyboardButton(f"@{p.username}", callback_data=f"reassign_choose_priest_{p.telegram_id}")]
-            for p in priests
-        ]
-        buttons.append([InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")])
-
+        kb = _priests_keyboard(
+            await _active_priests(),
+            "reassign_choose_priest_",
+            extra_rows=[[InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")]],
+        )
         await query.edit_message_text(
             "<b>🙏 Scegli il sacerdote a cui vuoi riassegnare una prenotazione:</b>",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=kb,
             parse_mode="HTML"
         )
         return
 
-    # 🔙 Torna alla lista prenotazioni (paginata)
-    if data == "reassign_back_to_bookings":
-        context.user_data["reassign_page"] = 1
-        await show_reassign_bookings_page(query, context)
-        return
-
-    # 🔄 Paginazione
-    if data == "reassign_page_prev":
-        context.user_data["reassign_page"] -= 1
-        await show_reassign_bookings_page(query, context)
+    # 1️⃣ Scelta sacerdote destinatario → scelta del sacerdote di partenza
+    if data.startswith("reassign_choose_priest_"):
+        await _show_reassign_sources(query, int(data.replace("reassign_choose_priest_", "")))
         return
 
-    if data == "reassign_page_next":
-        context.user_data["reassign_page"] += 1
-        await show_reassign_bookings_page(query, context)
+    # 2️⃣ Pagina di prenotazioni: reassign_list_<dest>_<origine|0>[_<cursore>]
+    if data.startswith("reassign_list_"):
+        parts = data.replace("reassign_list_", "").split("_")
+        cursor = parts[2] if len(parts) > 2 else None
+        await _show_reassign_page(query, int(parts[0]), int(parts[1]), cursor)
         return
 
-    # 1️⃣ Scelta sacerdote destinatario
-    if data.startswith("reassign_choose_priest_"):
-        priest_id = int(data.replace("reassign_choose_priest_", ""))
-        context.user_data["reassign_priest"] = priest_id
-
-        # 🔎 Recupera TUTTE le prenotazioni assegnate e non completate
-        session = SessionLocal()
-        try:
-            bookings = session.query(Booking).filter(
-                Booking.status == "assigned"
-            ).all()
-        finally:
-            session.close()
+    # 3️⃣ Scelta prenotazione → esegui riassegnamento
+    if data.startswith("reassign_choose_booking_"):
+        priest_id, booking_id = map(int, data.replace("reassign_choose_booking_", "").split("_"))
+        priest = await priest_directory.get(priest_id)
+        username = priest.username if priest else None
 
-        if not bookings:
+        if await complete_reassign(update, context, booking_id, priest_id, username):
             await query.edit_message_text(
-                "<b>❌ Non ci sono prenotazioni assegnate da riassegnare.</b>",
+                f"🔄 Prenotazione #{booking_id} riassegnata a {await priest_directory.tag(priest_id)}.",
                 parse_mode="HTML"
             )
-            return
-
-        # Salva lista prenotazioni e pagina corrente
-        context.user_data["reassign_bookings"] = [b.id for b in bookings]
-        context.user_data["reassign_page"] = 1
+        return
 
-        await show_reassign_bookings_page(query, context)
+    # 4️⃣ Riassegna tutto il carico di un sacerdote (conferma, poi una sola transazione)
+    if data.startswith("reassign_all_"):
+        to_priest_id, from_priest_id = map(int, data.replace("reassign_all_", "").split("_"))
+        from_tag = html.escape(await priest_directory.tag(from_priest_id))
+        to_tag = html.escape(await priest_directory.tag(to_priest_id))
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Conferma", callback_data=f"reassign_allok_{to_priest_id}_{from_priest_id}")],
+            [InlineKeyboardButton("⬅️ Indietro", callback_data=f"reassign_list_{to_priest_id}_{from_priest_id}")],
+        ])
+        await query.edit_message_text(
+            f"⚠️ Vuoi spostare <b>tutte</b> le prenotazioni assegnate di {from_tag} a {to_tag}?",
+            reply_markup=kb,
+            parse_mode="HTML"
+        )
         return
 
-    # 2️⃣ Scelta prenotazione → esegui riassegnamento
-    if data.startswith("reassign_choose_booking_"):
-        booking_id = int(data.replace("reassign_choose_booking_", ""))
-        priest_id = context.user_data.get("reassign_priest")
+    if data.startswith("reassign_allok_"):
+        to_priest_id, from_priest_id = map(int, data.replace("reassign_allok_", "").split("_"))
+        priest = await priest_directory.get(to_priest_id)
+        username = priest.username if priest else None
+        to_tag = await priest_directory.tag(to_priest_id)
 
         session = SessionLocal()
         try:
-            priest = session.query(Priest).filter(Priest.telegram_id == priest_id).first()
-            username = priest.username if priest else None
+            moved = await _reassign_bookings(
+                session,
+                _reassignable_criteria(to_priest_id, from_priest_id),
+                to_priest_id,
+                username,
+                update.effective_user.id,
+            )
+            ids_text = ", ".join(f"#{bid}" for bid in moved)
+            if moved:
+                await outbox_enqueue(
+                    session, f"reassign:u{update.update_id}:priest", "send_message",
+                    chat_id=to_priest_id,
+                    text=f"𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄 ⚓️\n\n🙏 Hey sacerdote! Ti sono appena state riassegnate {len(moved)} prenotazioni: {ids_text}.\n➡️ Utilizza /mie_assegnazioni per i dettagli.",
+                    parse_mode="HTML"
+                )
+            await session.commit()
         finally:
-            session.close()
+            await session.close()
+        outbox.notify()
+        event_log.log_many(moved, update.effective_user.id, "reassign", f"to {to_tag}")
 
-        await complete_reassign(update, context, booking_id, priest_id, username)
+        if not moved:
+            await query.edit_message_text(
+                "<b>❌ Non ci sono prenotazioni assegnate da riassegnare.</b>",
+                parse_mode="HTML"
+            )
+            return
 
         await query.edit_message_text(
-            f"🔄 Prenotazione #{booking_id} riassegnata a @{username}.",
+            f"🔄 {len(moved)} prenotazioni riassegnate a {to_tag}: {ids_text}",
             parse_mode="HTML"
         )
 
-async def show_reassign_bookings_page(query, context):
-    bookings = context.user_data.get("reassign_bookings", [])
-    page = context.user_data.get("reassign_page", 1)
-
-    per_page = 5
-    total_pages = (len(bookings) + per_page - 1) // per_page
-
-    start = (page - 1) * per_page
-    end = start + per_page
-    page_items = bookings[start:end]
-
-    buttons = [
-        [InlineKeyboardButton(f"Prenotazione #{bid}", callback_data=f"reassign_choose_booking_{bid}")]
-        for bid in page_items
-    ]
-
-    nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton("⬅️", callback_data="reassign_page_prev"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton("➡️", callback_data="reassign_page_next"))
-    if nav:
-        buttons.append(nav)
-
-    buttons.append([InlineKeyboardButton("⬅️ Indietro", callback_data="reassign_back_to_priests")])
-    buttons.append([InlineKeyboardButton("❌ Annulla", callback_data="reassign_cancel")])
-
-    await query.edit_message_text(
-        "<b>📋 Seleziona la prenotazione da riassegnare:</b>",
-        reply_markup=InlineKeyboardMarkup(buttons),
-        parse_mode="HTML"
-    )
-
 
 async def complete_reassign(update, context, booking_id, priest_id, username):
     session = SessionLocal()
     try:
-        booking = session.query(Booking).get(booking_id)
-        if not booking:
+        booking = await session.get(Booking, booking_id)
+        if not booking or booking.deleted_at:
             await update.effective_message.reply_text(
                 "❌ Prenotazione inesistente.",
                 parse_mode="HTML"
             )
-            return
+            return False
 
-        if booking.status in ("completed", "cancelled"):
+        if booking.status in ("completed", "canceled", "cancelled"):
             await update.effective_message.reply_text(
                 f"❌ La prenotazione #{booking.id} è {booking.status.upper()} e non può essere riassegnata.",
                 parse_mode="HTML"
             )
-            return
+            return False
 
-        existing_assign = session.query(Assignment).filter_by(booking_id=booking.id).first()
-        if not existing_assign:
+        # 🔄 RIASSEGNAZIONE: stesso percorso della riassegnazione in blocco
+        moved = await _reassign_bookings(
+            session, [Assignment.booking_id == booking.id], priest_id, username, update.effective_user.id
+        )
+        if not moved:
             await update.effective_message.reply_text(
                 f"⚠️ La prenotazione #{booking.id} non è ancora stata assegnata.",
                 parse_mode="HTML"
             )
-            return
+            return False
+        # Notifica sacerdote (outbox, stessa transazione della riassegnazione)
+        await outbox_enqueue(
+            session, f"reassign:u{update.update_id}:priest", "send_message",
+            chat_id=priest_id,
+            text=f"𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄 ⚓️\n\n🙏 Hey sacerdote! Ti è appena stata riassegnata una prenotazione #{booking_id}.\n➡️ Utilizza /mie_assegnazioni per i dettagli.",
+            parse_mode="HTML"
+        )
+        await session.commit()
+    finally:
+        await session.close()
+    outbox.notify()
+    event_log.log_many(moved, update.effective_user.id, "reassign", f"to {await priest_directory.tag(priest_id)}")
+    return True
+
+# ---- ASSEGNAZIONE AUTOMATICA ----
+AUTO_ASSIGN_SETTING = "auto_assign"
+AUTO_ASSIGN_BATCH = 200               # prenotazioni in attesa per transazione nel recupero in blocco
+SECRETARY_LOAD_WEIGHT = 2             # un incarico a un segretario "pesa" il doppio (ne riceve meno)
+OPEN_ASSIGNED_STATUSES = ("assigned", "in_progress")
+
+async def _auto_assign_enabled(session):
+    return await session.scalar(
+        select(BotSetting.value).where(BotSetting.key == AUTO_ASSIGN_SETTING)
+    ) == "on"
+
+async def _open_loads(session):
+    # 🔹 Carico reale: assegnazioni ancora aperte per sacerdote (non i contatori settimanali)
+    rows = (await session.execute(
+        select(Assignment.priest_telegram_id, func.count(Assignment.id))
+        .join(Booking, Booking.id == Assignment.booking_id)
+        .where(Booking.status.in_(OPEN_ASSIGNED_STATUSES), BOOKING_NOT_DELETED)
+        .group_by(Assignment.priest_telegram_id)
+    )).all()
+    return {pid: cnt for pid, cnt in rows}
+
+def _load_key(load, secretary):
+    # Stesse regole del menu "➕ Assegna": Direzione esclusa, segretari in coda
+    return (load + 1) * (SECRETARY_LOAD_WEIGHT if secretary else 1), secretary
+
+async def _auto_assign(session, criteria, actor_id, key, limit=None):
+    # 🔹 Assegna le prenotazioni in attesa che soddisfano "criteria" (nella transazione del chiamante):
+    #    min-heap sul carico aperto, ogni prenotazione va al sacerdote meno carico e il suo carico
+    #    torna nell'heap aumentato di uno. Righe bloccate con SKIP LOCKED (due recuperi in parallelo
+    #    non si contendono le stesse prenotazioni), scritture in blocco e notifiche nella outbox.
+    stmt = (
+        select(Booking.id, Booking.directors_message_id)
+        .where(Booking.status == "pending", BOOKING_NOT_DELETED, *criteria)
+        .order_by(Booking.id)
+        .with_for_update(skip_locked=True)
+    )
+    if limit:
+        stmt = stmt.limit(limit)
+    rows = (await session.execute(stmt)).all()
+    if not rows:
+        return []
+
+    candidates = [p for p in await _active_priests() if not is_director(p.telegram_id)]
+    if not candidates:
+        return []
+
+    loads = await _open_loads(session)
+    heap = []
+    for p in candidates:
+        load = loads.get(p.telegram_id, 0)
+        secretary = is_secretary(p.telegram_id)
+        heap.append((*_load_key(load, secretary), p.telegram_id, load, p))
+    heapq.heapify(heap)
+
+    assigned = []
+    for booking_id, directors_message_id in rows:
+        _, secretary, pid, load, priest = heapq.heappop(heap)
+        assigned.append((booking_id, directors_message_id, priest))
+        heapq.heappush(heap, (*_load_key(load + 1, secretary), pid, load + 1, priest))
+
+    now = datetime.now(timezone.utc)
+    booking_ids = [bid for bid, _, _ in assigned]
+    await session.execute(
+        sql_update(Booking)
+        .where(Booking.id.in_(booking_ids))
+        .values(status="assigned", updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(insert(Assignment), [
+        {
+            "booking_id": bid,
+            "priest_telegram_id": priest.telegram_id,
+            "priest_username": priest.username,
+            "assigned_by": actor_id,
+            "assigned_at": now,
+            "due_alert_sent": False,
+        }
+        for bid, _, priest in assigned
+    ])
 
-        # 🔄 RIASSEGNAZIONE (tua logica originale)
-        existing_assign.priest_telegram_id = priest_id
-        existing_assign.priest_username = username
-        existing_assign.assigned_by = update.effective_user.id
-        booking.updated_at = datetime.now(timezone.utc)
+    per_priest = {}
+    for bid, _, priest in assigned:
+        per_priest.setdefault(priest.telegram_id, []).append(bid)
+    for pid, ids in per_priest.items():
+        await _bump_workload(session, pid, now, assigned=len(ids))
+        ids_text = ", ".join(f"#{bid}" for bid in ids)
+        await outbox_enqueue(
+            session, f"{key}:priest:{pid}", "send_message",
+            chat_id=pid,
+            text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🙏 Hey sacerdote! Ti è stata <b>assegnata automaticamente</b> "
+            f"{'una nuova prenotazione' if len(ids) == 1 else f'{len(ids)} nuove prenotazioni'} ({ids_text}).\n"
+            "➡️ Utilizza <code>/mie_assegnazioni</code> per i dettagli.",
+            parse_mode="HTML"
+        )
+    # 🔹 Il pulsante "➕ Assegna" non serve più
+    for bid, directors_message_id, _ in assigned:
+        if directors_message_id:
+            await outbox_enqueue(
+                session, f"{key}:button:{bid}", "edit_message_reply_markup",
+                chat_id=DIRECTORS_GROUP_ID,
+                message_id=directors_message_id,
+                reply_markup=None
+            )
+    # Lo storico ("assign") lo accoda il chiamante dopo il commit
+    return [(bid, priest) for bid, _, priest in assigned]
 
-        session.add(existing_assign)
-        session.add(booking)
+def _log_auto_assign(assigned, actor_id):
+    per_priest = {}
+    for bid, priest in assigned:
+        per_priest.setdefault(priest.telegram_id, (priest, []))[1].append(bid)
+    for priest, ids in per_priest.values():
+        event_log.log_many(ids, actor_id, "assign", f"auto to {_priest_tag(priest)}")
 
-        session.add(EventLog(
-            booking_id=booking.id,
-            actor_id=update.effective_user.id,
-            action="reassign",
-            details=f"to @{username}"
-        ))
-        session.commit()
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def auto_assegna(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = context.args[0].lower() if context.args else ""
+    actor_id = update.effective_user.id
 
-        # Notifica sacerdote
+    if action in ("on", "off"):
+        session = SessionLocal()
         try:
-            await context.bot.send_message(
-                priest_id,
-                f"𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄 ⚓️\n\n🙏 Hey sacerdote! Ti è appena stata riassegnata una prenotazione #{booking.id}.\n➡️ Utilizza /mie_assegnazioni per i dettagli.",
-                parse_mode="HTML"
+            stmt = pg_insert(BotSetting).values(
+                key=AUTO_ASSIGN_SETTING, value=action, updated_by=actor_id, updated_at=datetime.now(timezone.utc)
             )
-        except:
-            pass
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[BotSetting.key],
+                set_={"value": stmt.excluded.value, "updated_by": stmt.excluded.updated_by, "updated_at": stmt.excluded.updated_at},
+            ))
+            await session.commit()
+        finally:
+            await session.close()
+        text_msg = (
+            "🤖 Assegnazione automatica <b>attivata</b>: le nuove prenotazioni vanno al sacerdote meno carico.\n"
+            "➡️ Usa <code>/auto_assegna tutte</code> per smaltire quelle già in attesa."
+            if action == "on" else
+            "⏸ Assegnazione automatica <b>disattivata</b>: si torna al pulsante \"➕ Assegna\"."
+        )
+        await update.message.reply_text(f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n{text_msg}", parse_mode="HTML")
+        return
 
-        # Cancella job precedente
-        for job in context.job_queue.get_jobs_by_name(f"notify_{booking.id}"):
-            job.schedule_removal()
+    if action == "tutte":
+        # 🔹 Arretrato a blocchi: una transazione per blocco, il carico viene riletto ogni volta
+        assigned = []
+        batch = 0
+        while True:
+            session = SessionLocal()
+            try:
+                chunk = await _auto_assign(
+                    session, [], actor_id, f"autoassign:u{update.update_id}:{batch}", limit=AUTO_ASSIGN_BATCH
+                )
+                await session.commit()
+            finally:
+                await session.close()
+            _log_auto_assign(chunk, actor_id)
+            assigned.extend(chunk)
+            batch += 1
+            if len(chunk) < AUTO_ASSIGN_BATCH:
+                break
+        outbox.notify()
+
+        if not assigned:
+            await update.message.reply_text(
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Nessuna prenotazione in attesa da assegnare "
+                "(oppure nessun sacerdote disponibile).",
+                parse_mode="HTML"
+            )
+            return
 
-        # Nuovo job 48h
-        context.job_queue.run_once(
-            notify_uncompleted,
-            when=48*3600,
-            data={"booking_id": booking.id, "priest_id": priest_id, "username": username},
-            name=f"notify_{booking.id}"
+        per_priest = {}
+        for _, priest in assigned:
+            per_priest.setdefault(priest.telegram_id, [priest, 0])[1] += 1
+        lines = [
+            f"- {html.escape(_priest_tag(priest))}: {count}"
+            for priest, count in sorted(per_priest.values(), key=lambda x: x[1], reverse=True)
+        ]
+        await update.message.reply_text(
+            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🤖 <b>{len(assigned)}</b> prenotazioni assegnate automaticamente:\n"
+            + "\n".join(lines),
+            parse_mode="HTML"
         )
+        return
 
+    session = SessionLocal()
+    try:
+        enabled = await _auto_assign_enabled(session)
     finally:
-        session.close()
+        await session.close()
+    state = "🟢 <b>attiva</b>" if enabled else "⚪️ <b>non attiva</b>"
+    await update.message.reply_text(
+        f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🤖 Assegnazione automatica: {state}\n\n"
+        "• <code>/auto_assegna on</code> → le nuove prenotazioni vanno al sacerdote meno carico\n"
+        "• <code>/auto_assegna off</code> → assegnazione manuale con \"➕ Assegna\"\n"
+        "• <code>/auto_assegna tutte</code> → assegna subito tutte le prenotazioni in attesa",
+        parse_mode="HTML"
+    )
 
-async def notify_uncompleted(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
-    booking_id = job_data["booking_id"]
+# ---- AVVISI 48H ----
+UNCOMPLETED_AFTER = timedelta(hours=48)
+UNCOMPLETED_SWEEP_INTERVAL = 10 * 60   # secondi tra due controlli
+UNCOMPLETED_SWEEP_BATCH = 200
+UNCOMPLETED_PER_MESSAGE = 30
+
+async def sweep_uncompleted(context: ContextTypes.DEFAULT_TYPE):
+    # 🔹 Un solo job periodico al posto di un timer per prenotazione: legge dal DB
+    #    le assegnazioni scadute (indice parziale su assigned_at) e le segnala in blocco
+    deadline = datetime.now(timezone.utc) - UNCOMPLETED_AFTER
 
     session = SessionLocal()
     try:
-        booking = session.query(Booking).get(booking_id)
-        if booking and booking.status == "assigned":
-            await context.bot.send_message(
-                DIRECTORS_GROUP_ID,
-                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ La prenotazione #{booking.id} assegnata al sacerdote <b>{job_data['username']}</b> non è stata completata entro <b>48 ore</b>.",
-                parse_mode="HTML",
-                message_thread_id=12872 
+        overdue = (await session.execute(
+            select(Assignment.id, Assignment.booking_id, Assignment.priest_username, Assignment.priest_telegram_id)
+            .join(Booking, Booking.id == Assignment.booking_id)
+            .where(
+                Assignment.due_alert_sent == False,
+                Assignment.assigned_at <= deadline,
+                Booking.status == "assigned",
+                BOOKING_NOT_DELETED,
+            )
+            .order_by(Assignment.assigned_at)
+            .limit(UNCOMPLETED_SWEEP_BATCH)
+        )).all()
+
+        for i in range(0, len(overdue), UNCOMPLETED_PER_MESSAGE):
+            chunk = overdue[i:i + UNCOMPLETED_PER_MESSAGE]
+
+            if len(chunk) == 1:
+                _, booking_id, username, priest_id = chunk[0]
+                text_msg = (
+                    f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ La prenotazione #{booking_id} assegnata al sacerdote "
+                    f"<b>{username or priest_id}</b> non è stata completata entro <b>48 ore</b>."
+                )
+            else:
+                lines = [
+                    f"• #{booking_id} → <b>{username or priest_id}</b>"
+                    for _, booking_id, username, priest_id in chunk
+                ]
+                text_msg = (
+                    "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ Le seguenti prenotazioni non sono state completate entro <b>48 ore</b>:\n\n"
+                    + "\n".join(lines)
+                )
+
+            await context.bot.send_message(
+                DIRECTORS_GROUP_ID,
+                text_msg,
+                parse_mode="HTML",
+                message_thread_id=12872
+            )
+
+            # 🔹 Segna come avvisate solo dopo l'invio riuscito
+            await session.execute(
+                sql_update(Assignment)
+                .where(Assignment.id.in_([row[0] for row in chunk]))
+                .values(due_alert_sent=True)
             )
+            await session.commit()
     finally:
-        session.close()
+        await session.close()
 
 # ---- SACERDOTE: LISTA E COMPLETAMENTO ----
+PRIEST_PAGE_SIZE = 5
+
+# 🔹 Ordine della dashboard: prima assigned, poi in_progress, poi il resto
+PRIEST_STATUS_RANK = case(
+    (Booking.status == "assigned", 0),
+    (Booking.status == "in_progress", 1),
+    else_=2,
+)
+
+def _priest_bookings_query(priest_id, *columns):
+    # 🔹 Query base condivisa: prenotazioni assegnate al sacerdote
+    return (
+        select(*(columns or (Booking,)))
+        .join(Assignment, Assignment.booking_id == Booking.id)
+        .where(Assignment.priest_telegram_id == priest_id, BOOKING_NOT_DELETED)
+    )
+
+async def _priest_dashboard_page(priest_id, page):
+    # 🔹 Una query per il totale e una per la sola pagina richiesta, già ordinata
+    session = SessionLocal()
+    try:
+        total = await session.scalar(_priest_bookings_query(priest_id, func.count(Booking.id)))
+        bookings = []
+        if total:
+            bookings = (await session.scalars(
+                _priest_bookings_query(priest_id)
+                .order_by(PRIEST_STATUS_RANK, Assignment.id.desc())
+                .limit(PRIEST_PAGE_SIZE)
+                .offset((page - 1) * PRIEST_PAGE_SIZE)
+            )).all()
+        return bookings, total
+    finally:
+        await session.close()
+
+def _render_priest_dashboard(bookings, page, total):
+    total_pages = (total + PRIEST_PAGE_SIZE - 1) // PRIEST_PAGE_SIZE
+
+    msgs = [render_booking_card(b, CARD_PRIEST) for b in bookings]
+
+    text = "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n" + "\n\n".join(msgs)
+    text += f"\n\n📄 Pagina {page}/{total_pages}"
+
+    # Bottoni di navigazione
+    buttons_nav = []
+    if page > 1:
+        buttons_nav.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"assign_page_{page-1}"))
+    if page < total_pages:
+        buttons_nav.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"assign_page_{page+1}"))
+
+    # Bottone completamento su riga separata
+    button_complete = [InlineKeyboardButton("✝️ Completa una prenotazione", callback_data="completa_menu")]
+
+    if buttons_nav:
+        kb = InlineKeyboardMarkup([buttons_nav, button_complete])
+    else:
+        kb = InlineKeyboardMarkup([button_complete])
+    return text, kb
+
+
 @role_required(is_priest, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire il comando.")
 async def mie_assegnazioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
@@ -1056,164 +1962,36 @@ async def mie_assegnazioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     priest_id = update.effective_user.id
-    session = SessionLocal()
-    try:
-        assigns_raw = (
-            session.query(Assignment)
-            .filter(Assignment.priest_telegram_id == priest_id)
-            .all()
-        )
-
-        if not assigns_raw:
-            await update.message.reply_text(
-                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>, ma questo durerà ancora per poco!",
-                parse_mode="HTML"
-            )
-            return
+    page = int(context.args[0]) if context.args else 1
+    bookings, total = await _priest_dashboard_page(priest_id, page)
 
-        # 🔹 Ordina: prima assigned, poi in_progress, poi completed
-        assigns = sorted(
-            assigns_raw,
-            key=lambda a: (
-                {"assigned": 0, "in_progress": 1, "completed": 2}.get(
-                    session.query(Booking).get(a.booking_id).status,
-                    2
-                ),
-                -a.id
-            )
+    if not total:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>, ma questo durerà ancora per poco!",
+            parse_mode="HTML"
         )
+        return
 
-        per_page = 5
-        page = int(context.args[0]) if context.args else 1
-        total_pages = (len(assigns) + per_page - 1) // per_page
-
-        start = (page - 1) * per_page
-        end = start + per_page
-        assigns_page = assigns[start:end]
-
-        msgs = []
-        for a in assigns_page:
-            b = session.query(Booking).get(a.booking_id)
-            if not b:
-                continue
-
-            if b.status == "assigned":
-                msgs.append(
-                    f"⚠️ <b>#{b.id} [DA COMPLETARE]</b> - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-            else:
-                msgs.append(
-                    f"✅ #{b.id} [{b.status.upper()}] - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-
-        text = "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n" + "\n\n".join(msgs)
-        text += f"\n\n📄 Pagina {page}/{total_pages}"
-
-        # Bottoni di navigazione
-        buttons_nav = []
-        if page > 1:
-            buttons_nav.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"assign_page_{page-1}"))
-        if page < total_pages:
-            buttons_nav.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"assign_page_{page+1}"))
-
-        # Bottone completamento
-        button_complete = [InlineKeyboardButton("✝️ Completa una prenotazione", callback_data="completa_menu")]
-
-        if buttons_nav:
-            kb = InlineKeyboardMarkup([buttons_nav, button_complete])
-        else:
-            kb = InlineKeyboardMarkup([button_complete])
+    text, kb = _render_priest_dashboard(bookings, page, total)
+    await update.message.reply_text(text, reply_markup=kb, parse_mode="HTML")
 
-        await update.message.reply_text(text, reply_markup=kb, parse_mode="HTML")
-    finally:
-        session.close()
 async def mie_assegnazioni_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     page = int(query.data.split("_")[-1])
 
     priest_id = query.from_user.id
-    session = SessionLocal()
-    try:
-        assigns_raw = (
-            session.query(Assignment)
-            .filter(Assignment.priest_telegram_id == priest_id)
-            .all()
-        )
-
-        if not assigns_raw:
-            await query.edit_message_text(
-                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>.",
-                parse_mode="HTML"
-            )
-            return
+    bookings, total = await _priest_dashboard_page(priest_id, page)
 
-        # 🔹 Ordina: prima assigned, poi in_progress, poi completed
-        assigns = sorted(
-            assigns_raw,
-            key=lambda a: (
-                {"assigned": 0, "in_progress": 1, "completed": 2}.get(
-                    session.query(Booking).get(a.booking_id).status,
-                    2
-                ),
-                -a.id
-            )
+    if not total:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>.",
+            parse_mode="HTML"
         )
+        return
 
-        per_page = 5
-        total_pages = (len(assigns) + per_page - 1) // per_page
-        start = (page - 1) * per_page
-        end = start + per_page
-        assigns_page = assigns[start:end]
-
-        msgs = []
-        for a in assigns_page:
-            b = session.query(Booking).get(a.booking_id)
-            if not b:
-                continue
-
-            if b.status == "assigned":
-                msgs.append(
-                    f"⚠️ <b>#{b.id} [DA COMPLETARE]</b> - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-            else:
-                msgs.append(
-                    f"✅ #{b.id} [{b.status.upper()}] - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-
-        text = "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n" + "\n\n".join(msgs)
-        text += f"\n\n📄 Pagina {page}/{total_pages}"
-
-        # Bottoni di navigazione
-        buttons_nav = []
-        if page > 1:
-            buttons_nav.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"assign_page_{page-1}"))
-        if page < total_pages:
-            buttons_nav.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"assign_page_{page+1}"))
-
-        # Bottone completamento
-        button_complete = [InlineKeyboardButton("✝️ Completa una prenotazione", callback_data="completa_menu")]
-
-        if buttons_nav:
-            kb = InlineKeyboardMarkup([buttons_nav, button_complete])
-        else:
-            kb = InlineKeyboardMarkup([button_complete])
-
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
-    finally:
-        session.close()
+    text, kb = _render_priest_dashboard(bookings, page, total)
+    await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
 
 
 # ---- Callback: mostra menu completamento ----
@@ -1223,33 +2001,26 @@ async def completa_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     priest_id = query.from_user.id
     session = SessionLocal()
     try:
-        assigns = (
-            session.query(Assignment)
-            .filter(Assignment.priest_telegram_id == priest_id)
-            .all()
-        )
-        if not assigns:
-            await query.edit_message_text(
-                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>.",
-                parse_mode="HTML"
-            )
-            return
-
-        keyboard = []
-        for a in assigns:
-            b = session.query(Booking).get(a.booking_id)
-            if b and b.status == "assigned":
-                keyboard.append([InlineKeyboardButton(f"#{b.id}", callback_data=f"completa_{b.id}")])
+        # 🔹 Solo gli ID delle prenotazioni ancora da completare, in una query
+        booking_ids = (await session.scalars(
+            _priest_bookings_query(priest_id, Booking.id)
+            .where(Booking.status == "assigned")
+            .order_by(Assignment.id.desc())
+        )).all()
+    finally:
+        await session.close()
 
-        keyboard.append([InlineKeyboardButton("⬅️ Torna indietro", callback_data="back_menu")])
+    keyboard = [
+        [InlineKeyboardButton(f"#{bid}", callback_data=f"completa_{bid}")]
+        for bid in booking_ids
+    ]
+    keyboard.append([InlineKeyboardButton("⬅️ Torna indietro", callback_data="back_menu")])
 
-        await query.edit_message_text(
-            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✝️ Seleziona l'<b>ID della prenotazione</b> che vuoi contrassegnare come <b>completata</b>:",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    finally:
-        session.close()
+    await query.edit_message_text(
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✝️ Seleziona l'<b>ID della prenotazione</b> che vuoi contrassegnare come <b>completata</b>:",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
         
 
 # ---- Callback: completa prenotazione ----
@@ -1261,8 +2032,8 @@ async def completa_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     session = SessionLocal()
     try:
-        b = session.query(Booking).get(booking_id)
-        if not b:
+        b = await session.get(Booking, booking_id)
+        if not b or b.deleted_at:
             await query.message.reply_text(
                 "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ L'<b>ID della prenotazione</b> selezionata risulta inesistente.",
                 parse_mode="HTML"
@@ -1276,10 +2047,10 @@ async def completa_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        a = session.query(Assignment).filter(
+        a = await session.scalar(select(Assignment).filter(
             Assignment.booking_id == booking_id,
             Assignment.priest_telegram_id == priest_id
-        ).first()
+        ))
         if not a:
             await query.message.reply_text(
                 "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ L'<b>ID della prenotazione</b> selezionata non ti è assegnata.",
@@ -1288,102 +2059,57 @@ async def completa_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Aggiorna stato
+        now = datetime.now(timezone.utc)
         b.status = "completed"
-        b.updated_at = datetime.now(timezone.utc)
+        b.updated_at = now
+        # 🔹 Esce dall'indice degli avvisi 48h
+        a.due_alert_sent = True
         session.add(b)
-        session.add(EventLog(booking_id=b.id, actor_id=priest_id, action="complete", details=""))
-        session.commit()
-
-        # Cancella eventuale job di notifica 48h
-        for job in context.job_queue.get_jobs_by_name(f"notify_{b.id}"):
-            job.schedule_removal()
-
-        await query.message.reply_text(
-            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✅ Grande! Prenotazione #{b.id} contrassegnata come <b>completata</b>.",
-            parse_mode="HTML"
-        )
-        await context.bot.send_message(
-            DIRECTORS_GROUP_ID,
-            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✝️ Sacramento <b>completato</b> #{b.id} da @{query.from_user.username or priest_id}.",
+        session.add(a)
+        await _bump_workload(session, priest_id, now, completed=1)
+        # 🔹 Notifica alla Direzione nella outbox (una sola per prenotazione completata)
+        await outbox_enqueue(
+            session, f"complete:{b.id}:directors", "send_message",
+            chat_id=DIRECTORS_GROUP_ID,
+            text=f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✝️ Sacramento <b>completato</b> #{b.id} da @{query.from_user.username or priest_id}.",
             parse_mode="HTML",
             message_thread_id=DIRECTORS_TOPIC_ID   # 🔹 aggiunto parametro per inviare nel topic
         )
+        await session.commit()
+        outbox.notify()
+        event_log.log(b.id, priest_id, "complete")
 
         # 🔹 Rimuovi bottone corrispondente
         keyboard = query.message.reply_markup.inline_keyboard
         new_keyboard = [row for row in keyboard if not any(btn.callback_data == f"completa_{booking_id}" for btn in row)]
-        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(new_keyboard))
+
+        # 🔹 Conferma e tastiera aggiornata partono insieme
+        await send_all(
+            query.message.reply_text(
+                f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n✅ Grande! Prenotazione #{b.id} contrassegnata come <b>completata</b>.",
+                parse_mode="HTML"
+            ),
+            query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(new_keyboard)),
+        )
     finally:
-        session.close()
+        await session.close()
 async def back_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     priest_id = query.from_user.id
-    session = SessionLocal()
-    try:
-        assigns = (
-            session.query(Assignment)
-            .filter(Assignment.priest_telegram_id == priest_id)
-            .order_by(Assignment.id.desc())
-            .all()
-        )
-        if not assigns:
-            await query.edit_message_text(
-                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>, ma questo durerà ancora per poco!",
-                parse_mode="HTML"
-            )
-            return
+    page = 1   # 🔹 quando torni indietro riparti dalla prima pagina
+    bookings, total = await _priest_dashboard_page(priest_id, page)
 
-        per_page = 5
-        page = 1   # 🔹 quando torni indietro riparti dalla prima pagina
-        total_pages = (len(assigns) + per_page - 1) // per_page
-
-        start = (page - 1) * per_page
-        end = start + per_page
-        assigns_page = assigns[start:end]
-
-        msgs = []
-        for a in assigns_page:
-            b = session.query(Booking).get(a.booking_id)
-            if not b:
-                continue
-            if b.status == "assigned":
-                msgs.append(
-                    f"⚠️ <b>#{b.id} [DA COMPLETARE]</b> - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-            else:
-                msgs.append(
-                    f"✅ #{b.id} [{b.status.upper()}] - {b.sacrament.replace('_',' ')}\n"
-                    f"👤 Contatto TG: {b.rp_name or 'Nessun contatto presente.'}\n"
-                    f"🎮 Nick: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                    f"📝 Note: {b.notes or 'Nessuna nota.'}"
-                )
-
-        text = "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n" + "\n\n".join(msgs)
-        text += f"\n\n📄 Pagina {page}/{total_pages}"
-
-        # Bottoni di navigazione
-        buttons_nav = []
-        if page > 1:
-            buttons_nav.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"assign_page_{page-1}"))
-        if page < total_pages:
-            buttons_nav.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"assign_page_{page+1}"))
-
-        # Bottone completamento su riga separata
-        button_complete = [InlineKeyboardButton("✝️ Completa una prenotazione", callback_data="completa_menu")]
-
-        if buttons_nav:
-            kb = InlineKeyboardMarkup([buttons_nav, button_complete])
-        else:
-            kb = InlineKeyboardMarkup([button_complete])
+    if not total:
+        await query.edit_message_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Al momento non ti è stata <b>assegnata alcuna prenotazione</b>, ma questo durerà ancora per poco!",
+            parse_mode="HTML"
+        )
+        return
 
-        await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
-    finally:
-        session.close()
+    text, kb = _render_priest_dashboard(bookings, page, total)
+    await query.edit_message_text(text, reply_markup=kb, parse_mode="HTML")
 
 
 # ---- CANCEL ----
@@ -1425,167 +2151,55 @@ async def lista_prenotazioni_callback(update: Update, context: ContextTypes.DEFA
     query = update.callback_query
     await query.answer()
     data = query.data
-    session = SessionLocal()
-    try:
-        if data.startswith("filter_"):
-            filtro = data.replace("filter_", "")
-            # 🔹 Filtra per stato (pending / assigned / completed)
-            if filtro in STATUS:
-                context.user_data["last_list"] = {
-                    "kind": "status",
-                    "status": filtro,
-                    "title": f"📋 Prenotazioni {filtro.upper()}"
-                }
-                bookings = session.query(Booking).filter(
-                    Booking.status == filtro
-                ).order_by(Booking.id.desc()).all()
-
-                await _send_paginated_bookings(
-                    query, bookings, f"📋 Prenotazioni {filtro.upper()}",
-                    filtro, page=1
-                )
-
-            # 🔹 Filtra per sacerdote → mostra elenco sacerdoti
-            elif filtro == "priests":
-                priests = session.query(Priest).all()
-                buttons = [
-                    [InlineKeyboardButton(f"@{p.username or p.telegram_id}", callback_data=f"priest_{p.telegram_id}")]
-                    for p in priests
-                ]
-                buttons.append([InlineKeyboardButton("⬅️ Torna indietro", callback_data="back_main")])
-
-                new_text = (
-                    "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-                    "🙏 Scegli un sacerdote:"
-                )
-                new_markup = InlineKeyboardMarkup(buttons)
-
-                if query.message.text != new_text or query.message.reply_markup != new_markup:
-                    await query.edit_message_text(new_text, reply_markup=new_markup, parse_mode="HTML")
-        elif data.startswith("priest_"):
-            priest_id = int(data.replace("priest_", ""))
-            priest = session.query(Priest).filter(
-                Priest.telegram_id == priest_id
-            ).first()
-            priest_tag = f"@{priest.username}" if priest and priest.username else str(priest_id)
-            # 🔹 Recupera TUTTE le prenotazioni del sacerdote
-            assigns = session.query(Assignment).filter(
-                Assignment.priest_telegram_id == priest_id
-            ).all()
-            bookings = [
-                session.query(Booking).get(a.booking_id)
-                for a in assigns
-                if session.query(Booking).get(a.booking_id)
-            ]
-            bookings = sorted(
-                bookings,
-                key=lambda b: (
-                    0 if b.status == "assigned" else 1,
-                    -b.id
-                )
-            )
-
+    if data.startswith("filter_"):
+        filtro = data.replace("filter_", "")
+        # 🔹 Filtra per stato (pending / assigned / completed)
+        if filtro in STATUS:
             context.user_data["last_list"] = {
-                "kind": "priest_all",
-                "priest_id": priest_id,
-                "title": f"📋 Prenotazioni sacerdote {priest_tag}"
+                "kind": "status",
+                "status": filtro,
+                "title": f"📋 Prenotazioni {filtro.upper()}"
             }
+            await _send_paginated_bookings(query, context.user_data["last_list"], page=1)
+
+        # 🔹 Filtra per sacerdote → mostra elenco sacerdoti
+        elif filtro == "priests":
+            priests = await _active_priests()
+            buttons = [
+                [InlineKeyboardButton(_priest_tag(p), callback_data=f"priest_{p.telegram_id}")]
+                for p in priests
+            ]
+            buttons.append([InlineKeyboardButton("⬅️ Torna indietro", callback_data="back_main")])
 
-            await _send_paginated_bookings(
-                query,
-                bookings,
-                f"📋 Prenotazioni sacerdote {priest_tag}",
-                f"{priest_id}",
-                page=1
+            new_text = (
+                "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+                "🙏 Scegli un sacerdote:"
             )
+            new_markup = InlineKeyboardMarkup(buttons)
 
-        elif data.startswith("bookings_page_"):
-            payload = data[len("bookings_page_"):]
-            try:
-                page_part, filtro = payload.split("_", 1)
-                page = int(page_part)
-            except:
-                # Torna al pannello principale
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⏳ In attesa", callback_data="filter_pending")],
-                    [InlineKeyboardButton("📌 Assegnate", callback_data="filter_assigned")],
-                    [InlineKeyboardButton("✅ Completate", callback_data="filter_completed")],
-                    [InlineKeyboardButton("🙏 Per sacerdote", callback_data="filter_priests")],
-                    [InlineKeyboardButton("🎮 Cerca fedele", callback_data="search_fedele")],
-                    [InlineKeyboardButton("🔎 Cerca per ID", callback_data="search_id")],
-                    [InlineKeyboardButton("❌ Chiudi Pannello", callback_data="close_panel")],
-                ])
-                new_text = (
-                    "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
-                    "📋 Scegli il tipo di prenotazioni da visualizzare:"
-                )
-                await query.edit_message_text(new_text, reply_markup=kb, parse_mode="HTML")
-                return
-
-            last = context.user_data.get("last_list") or {}
-            kind = last.get("kind")
-
-            # 🔹 Paginazione per stato
-            if kind == "status":
-                status = last.get("status")
-                bookings = session.query(Booking).filter(
-                    Booking.status == status
-                ).order_by(Booking.id.desc()).all()
-
-                title = last.get("title") or f"📋 Prenotazioni {status.upper()}"
-                await _send_paginated_bookings(query, bookings, title, status, page=page)
-
-            # 🔹 Paginazione per sacerdote (TUTTE le prenotazioni)
-            elif kind == "priest_all":
-                priest_id = last.get("priest_id")
-                priest = session.query(Priest).filter(
-                    Priest.telegram_id == int(priest_id)
-                ).first()
-
-                priest_tag = f"@{priest.username}" if priest and priest.username else str(priest_id)
-
-                assigns = session.query(Assignment).filter(
-                    Assignment.priest_telegram_id == int(priest_id)
-                ).all()
-
-                bookings = [
-                    session.query(Booking).get(a.booking_id)
-                    for a in assigns
-                    if session.query(Booking).get(a.booking_id)
-                ]
-
-                # 🔹 Ordine richiesto
-                bookings = sorted(
-                    bookings,
-                    key=lambda b: (
-                        0 if b.status == "assigned" else 1,
-                        -b.id
-                    )
-                )
-
-                title = last.get("title") or f"📋 Prenotazioni sacerdote {priest_tag}"
-                await _send_paginated_bookings(query, bookings, title, f"{priest_id}", page=page)
-
-            # 🔹 Ricerca nickname
-            elif kind == "search_nick":
-                term = last.get("term") or ""
-                bookings = session.query(Booking).filter(
-                    Booking.nickname_mc.ilike(f"%{term}%")
-                ).order_by(Booking.id.desc()).all()
-
-                title = last.get("title") or f"📋 Prenotazioni del fedele '{term}'"
-                await _send_paginated_bookings(query, bookings, title, term, page=page)
+            if query.message.text != new_text or query.message.reply_markup != new_markup:
+                await query.edit_message_text(new_text, reply_markup=new_markup, parse_mode="HTML")
+    elif data.startswith("priest_"):
+        priest_id = int(data.replace("priest_", ""))
+        priest_tag = await priest_directory.tag(priest_id)
 
-            # 🔹 Ricerca per ID
-            elif kind == "search_id":
-                bid = last.get("booking_id")
-                booking = session.query(Booking).get(bid) if bid else None
-                bookings = [booking] if booking else []
+        # 🔹 TUTTE le prenotazioni del sacerdote (ordinamento e paginazione nel DB)
+        context.user_data["last_list"] = {
+            "kind": "priest_all",
+            "priest_id": priest_id,
+            "title": f"📋 Prenotazioni sacerdote {priest_tag}"
+        }
 
-                title = last.get("title") or f"📋 Prenotazione #{bid}"
-                await _send_paginated_bookings(query, bookings, title, str(bid or ""), page=page)
+        await _send_paginated_bookings(query, context.user_data["last_list"], page=1)
 
-        elif data == "back_main":
+    elif data.startswith("bookings_page_"):
+        payload = data[len("bookings_page_"):]
+        try:
+            page_part, cursor_part = payload.split("_", 1)
+            page = int(page_part)
+            cursor = _parse_bookings_cursor(cursor_part)
+        except:
+            # Torna al pannello principale
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("⏳ In attesa", callback_data="filter_pending")],
                 [InlineKeyboardButton("📌 Assegnate", callback_data="filter_assigned")],
@@ -1600,32 +2214,52 @@ async def lista_prenotazioni_callback(update: Update, context: ContextTypes.DEFA
                 "📋 Scegli il tipo di prenotazioni da visualizzare:"
             )
             await query.edit_message_text(new_text, reply_markup=kb, parse_mode="HTML")
+            return
 
-        elif data == "search_fedele":
-            msg = await query.message.reply_text(
-                "✍️ Inserisci il nickname del fedele con un messaggio in chat:",
-                parse_mode="HTML",
-                message_thread_id=DIRECTORS_TOPIC_ID
-            )
-            context.user_data["search_mode"] = "fedele"
-            context.user_data["last_prompt_message_id"] = msg.message_id
+        # 🔹 Il filtro resta in user_data, il cursore arriva dal bottone
+        last = context.user_data.get("last_list") or {}
+        if _booking_list_criteria(last) is not None:
+            await _send_paginated_bookings(query, last, page=page, cursor=cursor)
 
-        elif data == "search_id":
-            msg = await query.message.reply_text(
-                "✍️ Inserisci l'ID della prenotazione con un messaggio in chat:",
-                parse_mode="HTML",
-                message_thread_id=DIRECTORS_TOPIC_ID
-            )
-            context.user_data["search_mode"] = "id"
-            context.user_data["last_prompt_message_id"] = msg.message_id
+    elif data == "back_main":
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⏳ In attesa", callback_data="filter_pending")],
+            [InlineKeyboardButton("📌 Assegnate", callback_data="filter_assigned")],
+            [InlineKeyboardButton("✅ Completate", callback_data="filter_completed")],
+            [InlineKeyboardButton("🙏 Per sacerdote", callback_data="filter_priests")],
+            [InlineKeyboardButton("🎮 Cerca fedele", callback_data="search_fedele")],
+            [InlineKeyboardButton("🔎 Cerca per ID", callback_data="search_id")],
+            [InlineKeyboardButton("❌ Chiudi Pannello", callback_data="close_panel")],
+        ])
+        new_text = (
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n"
+            "📋 Scegli il tipo di prenotazioni da visualizzare:"
+        )
+        await query.edit_message_text(new_text, reply_markup=kb, parse_mode="HTML")
 
-        elif data == "close_panel":
-            try:
-                await query.message.delete()
-            except:
-                pass
-    finally:
-        session.close()
+    elif data == "search_fedele":
+        msg = await query.message.reply_text(
+            "✍️ Inserisci il nickname del fedele con un messaggio in chat:",
+            parse_mode="HTML",
+            message_thread_id=DIRECTORS_TOPIC_ID
+        )
+        context.user_data["search_mode"] = "fedele"
+        context.user_data["last_prompt_message_id"] = msg.message_id
+
+    elif data == "search_id":
+        msg = await query.message.reply_text(
+            "✍️ Inserisci l'ID della prenotazione con un messaggio in chat:",
+            parse_mode="HTML",
+            message_thread_id=DIRECTORS_TOPIC_ID
+        )
+        context.user_data["search_mode"] = "id"
+        context.user_data["last_prompt_message_id"] = msg.message_id
+
+    elif data == "close_panel":
+        try:
+            await query.message.delete()
+        except:
+            pass
 
 
 async def lista_prenotazioni_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1646,88 +2280,195 @@ async def lista_prenotazioni_search(update: Update, context: ContextTypes.DEFAUL
         # resetta l'ID del prompt
         context.user_data["last_prompt_message_id"] = None
 
-    session = SessionLocal()
-    try:
-        if mode == "fedele":
-            filtro = update.message.text.strip()
-            bookings = session.query(Booking).filter(
-                Booking.nickname_mc.ilike(f"%{filtro}%")
-            ).order_by(Booking.id.desc()).all()
-
-            if bookings:
-                context.user_data["last_list"] = {
-                    "kind": "search_nick",
-                    "term": filtro,
-                    "title": f"📋 Prenotazioni del fedele '{filtro}'"
-                }
-
-                await _send_paginated_bookings(
-                    update.message,
-                    bookings,
-                    f"📋 Prenotazioni del fedele '{filtro}'",
-                    filtro,
-                    page=1
-                )
-            else:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")]
-                ])
-                await update.message.reply_text(
-                    f"❌ Nessuna prenotazione trovata per il fedele <b>{filtro}</b>.",
-                    reply_markup=kb,
-                    parse_mode="HTML",
-                    message_thread_id=DIRECTORS_TOPIC_ID   # 🔹 invio nel topic
-                )
-        elif mode == "id":
-            try:
-                booking_id = int(update.message.text.strip())
-            except ValueError:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")]
-                ])
-                await update.message.reply_text(
-                    "❌ Devi inserire un ID numerico valido.",
-                    reply_markup=kb,
-                    parse_mode="HTML",
-                    message_thread_id=DIRECTORS_TOPIC_ID   # 🔹 invio nel topic
-                )
-                return
+    if mode == "fedele":
+        filtro = update.message.text.strip()
+        # 🔹 La ricerca gira una volta sola: le pagine scorrono gli ID già ordinati per pertinenza
+        ids, truncated = await _search_booking_ids(filtro)
+        context.user_data["last_list"] = {
+            "kind": "search_nick",
+            "term": filtro,
+            "ids": ids,
+            "truncated": truncated,
+            "title": f"📋 Prenotazioni del fedele '{filtro}'"
+        }
+        await _send_paginated_bookings(
+            update.message,
+            context.user_data["last_list"],
+            page=1,
+            empty_text=f"❌ Nessuna prenotazione trovata per il fedele <b>{filtro}</b>."
+        )
+    elif mode == "id":
+        try:
+            booking_id = int(update.message.text.strip())
+        except ValueError:
+            kb = InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")]
+            ])
+            await update.message.reply_text(
+                "❌ Devi inserire un ID numerico valido.",
+                reply_markup=kb,
+                parse_mode="HTML",
+                message_thread_id=DIRECTORS_TOPIC_ID   # 🔹 invio nel topic
+            )
+            return
 
-            booking = session.query(Booking).get(booking_id)
-            if booking:
-                context.user_data["last_list"] = {
-                    "kind": "search_id",
-                    "booking_id": booking_id,
-                    "title": f"📋 Prenotazione #{booking_id}"
-                }
-
-                await _send_paginated_bookings(
-                    update.message,
-                    [booking],
-                    f"📋 Prenotazione #{booking_id}",
-                    str(booking_id),
-                    page=1
-                )
-            else:
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")]
-                ])
-                await update.message.reply_text(
-                    f"❌ Nessuna prenotazione trovata con ID <b>{booking_id}</b>.",
-                    reply_markup=kb,
-                    parse_mode="HTML",
-                    message_thread_id=DIRECTORS_TOPIC_ID   # 🔹 invio nel topic
-                )
-    finally:
-        session.close()
+        context.user_data["last_list"] = {
+            "kind": "search_id",
+            "booking_id": booking_id,
+            "title": f"📋 Prenotazione #{booking_id}"
+        }
+        await _send_paginated_bookings(
+            update.message,
+            context.user_data["last_list"],
+            page=1,
+            empty_text=f"❌ Nessuna prenotazione trovata con ID <b>{booking_id}</b>."
+        )
 
     # 🔹 Reset modalità ricerca
     context.user_data["search_mode"] = None
 
 
-async def _send_paginated_bookings(target, bookings, titolo, filtro, page=1):
-    if not bookings:
-        msg = f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Nessuna prenotazione trovata per <b>{titolo}</b>."
+BOOKINGS_PER_PAGE = 5
+
+# ---- RICERCA FEDELE ----
+SEARCH_MAX_RESULTS = 50     # oltre, la lista lo segnala e chiede una ricerca più precisa
+SEARCH_PREFIX_MAX_LEN = 2   # termini più corti: niente trigrammi, solo completamento del prefisso
+
+def _like_escape(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def _search_booking_ids(term):
+    # 🔹 Indici pg_trgm su nickname_mc/rp_name (vedi migrations.py): tollera errori di battitura
+    #    e ordina per somiglianza; per 1-2 caratteri usa l'indice sul prefisso del nickname
+    #    Restituisce (id, troncata): troncata se c'erano più di SEARCH_MAX_RESULTS risultati
+    term = term.strip().lower()
+    if not term:
+        return [], False
+
+    if len(term) <= SEARCH_PREFIX_MAX_LEN:
+        stmt = (
+            select(Booking.id)
+            .where(func.lower(Booking.nickname_mc).like(_like_escape(term) + "%", escape="\\"), BOOKING_NOT_DELETED)
+            .order_by(Booking.id.desc())
+        )
+    else:
+        score = func.greatest(
+            func.similarity(func.coalesce(Booking.nickname_mc, ""), term),
+            func.similarity(func.coalesce(Booking.rp_name, ""), term),
+        )
+        stmt = (
+            select(Booking.id)
+            .where(
+                or_(
+                    Booking.nickname_mc.op("%")(term),
+                    Booking.rp_name.op("%")(term),
+                    Booking.nickname_mc.ilike("%" + _like_escape(term) + "%", escape="\\"),
+                ),
+                BOOKING_NOT_DELETED,
+            )
+            .order_by(score.desc(), Booking.id.desc())
+        )
+
+    session = SessionLocal()
+    try:
+        # Un ID in più solo per sapere se la lista è stata tagliata
+        ids = list((await session.scalars(stmt.limit(SEARCH_MAX_RESULTS + 1))).all())
+    finally:
+        await session.close()
+    return ids[:SEARCH_MAX_RESULTS], len(ids) > SEARCH_MAX_RESULTS
+
+def _booking_list_criteria(last_list):
+    # 🔹 Traduce il filtro salvato in user_data["last_list"] in condizioni SQL
+    kind = last_list.get("kind")
+    if kind == "status":
+        return [Booking.status == last_list.get("status"), BOOKING_NOT_DELETED]
+    if kind == "priest_all":
+        return [Assignment.priest_telegram_id == int(last_list.get("priest_id")), BOOKING_NOT_DELETED]
+    if kind == "search_nick":
+        return [Booking.id.in_(last_list.get("ids") or []), BOOKING_NOT_DELETED]
+    if kind == "search_id":
+        return [Booking.id == last_list.get("booking_id"), BOOKING_NOT_DELETED]
+    return None
+
+def _booking_list_rank(last_list):
+    # 🔹 Per sacerdote: prima le assegnate, poi le altre (più recenti in alto)
+    if last_list.get("kind") == "priest_all":
+        return case((Booking.status == "assigned", 0), else_=1)
+    # 🔹 Ricerca fedele: la posizione nella classifica di pertinenza
+    if last_list.get("kind") == "search_nick" and last_list.get("ids"):
+        ids = last_list["ids"]
+        return case({bid: pos for pos, bid in enumerate(ids)}, value=Booking.id, else_=len(ids))
+    return None
+
+def _booking_list_seek(rank, cursor_rank, cursor_id, forward):
+    # 🔹 Keyset su (rank ASC, id DESC): righe dopo (avanti) o prima (indietro) del cursore
+    if forward:
+        id_cond = Booking.id < cursor_id
+        return id_cond if rank is None else or_(rank > cursor_rank, and_(rank == cursor_rank, id_cond))
+    id_cond = Booking.id > cursor_id
+    return id_cond if rank is None else or_(rank < cursor_rank, and_(rank == cursor_rank, id_cond))
+
+def _parse_bookings_cursor(cursor):
+    # 🔹 Formato: "n<rank>.<id>" (avanti) oppure "p<rank>.<id>" (indietro)
+    if cursor[0] not in ("n", "p"):
+        raise ValueError(cursor)
+    rank_part, id_part = cursor[1:].split(".")
+    return cursor[0] == "n", int(rank_part), int(id_part)
+
+
+async def _send_paginated_bookings(target, last_list, page=1, cursor=None, empty_text=None):
+    titolo = last_list.get("title")
+    criteria = _booking_list_criteria(last_list) or []
+    per_page = BOOKINGS_PER_PAGE
+    rank = _booking_list_rank(last_list)
+    rank_col = rank if rank is not None else literal(0)
+
+    session = SessionLocal()
+    try:
+        # 🔹 Totale calcolato dal DB una sola volta e salvato col filtro
+        total = last_list.get("total")
+        if cursor is None or total is None:
+            total = await session.scalar(
+                select(func.count(Booking.id))
+                .outerjoin(Assignment, Assignment.booking_id == Booking.id)
+                .where(*criteria)
+            )
+            last_list["total"] = total
+
+        # 🔹 Una sola query per la pagina: prenotazione + sacerdote assegnato.
+        #    Niente OFFSET: si riparte dal cursore, quindi la pagina N costa come la 1
+        stmt = (
+            select(Booking, Assignment.priest_telegram_id, rank_col)
+            .outerjoin(Assignment, Assignment.booking_id == Booking.id)
+            .where(*criteria)
+        )
+        forward = True
+        if cursor is not None:
+            forward, cursor_rank, cursor_id = cursor
+            stmt = stmt.where(_booking_list_seek(rank, cursor_rank, cursor_id, forward))
+
+        if forward:
+            order = [Booking.id.desc()] if rank is None else [rank.asc(), Booking.id.desc()]
+        else:
+            order = [Booking.id.asc()] if rank is None else [rank.desc(), Booking.id.asc()]
+
+        rows = []
+        if total:
+            # 🔹 Una riga in più per sapere se esiste la pagina successiva
+            rows = (await session.execute(stmt.order_by(*order).limit(per_page + 1))).all()
+    finally:
+        await session.close()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if forward:
+        has_prev, has_next = cursor is not None, more
+    else:
+        rows.reverse()
+        has_prev, has_next = more, True
+
+    if not rows:
+        msg = empty_text or f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Nessuna prenotazione trovata per <b>{titolo}</b>."
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")]
         ])
@@ -1739,58 +2480,47 @@ async def _send_paginated_bookings(target, bookings, titolo, filtro, page=1):
                 await target.edit_message_text(msg, reply_markup=kb, parse_mode="HTML")
         return
 
-    per_page = 5
-    total_pages = (len(bookings) + per_page - 1) // per_page
-    start = (page - 1) * per_page
-    end = start + per_page
-    bookings_page = bookings[start:end]
+    total_pages = max((total + per_page - 1) // per_page, page)
+
+    if last_list.get("truncated"):
+        lines = [f"--- 📋 {titolo} --- (Primi {total} risultati)"]
+    else:
+        lines = [f"--- 📋 {titolo} --- (Totale: {total})"]
 
-    lines = [f"--- 📋 {titolo} --- (Totale: {len(bookings)})"]
+    # 🔹 Username dei sacerdoti della pagina dalla directory in memoria
+    priests = await priest_directory.get_many(row[1] for row in rows if row[1])
 
-    session = SessionLocal()
-    try:
-        for b in bookings_page:
-            assignment = session.query(Assignment).filter_by(booking_id=b.id).first()
-
-            priest_tag = "Nessuno."
-            if assignment and getattr(assignment, "priest_telegram_id", None):
-                priest = session.query(Priest).filter(Priest.telegram_id == assignment.priest_telegram_id).first()
-                if priest and priest.username:
-                    priest_tag = f"@{priest.username}"
-                else:
-                    priest_tag = str(assignment.priest_telegram_id)
-
-            secretary_tag = f"@{b.secretary_username}" if getattr(b, "secretary_username", None) else "Nessun contatto presente."
-            timestamp = b.created_at.strftime("%d/%m/%Y %H:%M") if getattr(b, "created_at", None) else "-"
-
-            lines.append(
-                f"📌 Prenotazione #{b.id} [{b.status.upper()}]\n"
-                f"• ✝️ Sacramento/i: {b.sacrament.replace('_',' ')}\n"
-                f"• 🎮 Nick Minecraft: {b.nickname_mc or 'Nessun nickname inserito.'}\n"
-                f"• 👤 Contatto TG fedele: {b.rp_name or 'Nessun contatto inserito.'}\n"
-                f"• 📝 Note: {b.notes or 'Nessuna nota.'}\n"
-                f"• 📖 Registrata dal segretario: {secretary_tag}\n"
-                f"• ⏰ Orario: {timestamp}\n"
-                f"• 🙏 Assegnata a: {priest_tag}\n"
-                "-----------------------------"
-            )
-    finally:
-        session.close()
+    for b, priest_id, _ in rows:
+        priest_tag = "Nessuno."
+        if priest_id:
+            priest = priests.get(priest_id)
+            priest_tag = f"@{priest.username}" if priest and priest.username else str(priest_id)
+
+        # 🔹 Scheda dalla cache; il sacerdote resta fuori (lo username può cambiare senza toccare la prenotazione)
+        lines.append(
+            render_booking_card(b, CARD_PANEL)
+            + f"• 🙏 Assegnata a: {html.escape(priest_tag)}\n"
+            "-----------------------------"
+        )
 
     text = "\n".join(lines) + f"\n\n📄 Pagina {page}/{total_pages}"
+    if last_list.get("truncated"):
+        text += f"\nℹ️ Mostrati solo i primi {SEARCH_MAX_RESULTS} risultati: affina la ricerca."
 
+    # 🔹 Il cursore viaggia nel bottone: (rank, id) della prima/ultima riga della pagina
+    first, last = rows[0], rows[-1]
     keyboard = []
     nav_buttons = []
-    if page > 1:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"bookings_page_{page-1}_{filtro or 'all'}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"bookings_page_{page+1}_{filtro or 'all'}"))
+    if has_prev and page > 1:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"bookings_page_{page-1}_p{first[2]}.{first[0].id}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton("Avanti ➡️", callback_data=f"bookings_page_{page+1}_n{last[2]}.{last[0].id}"))
     if nav_buttons:
         keyboard.append(nav_buttons)
 
     keyboard.append([InlineKeyboardButton("⬅️ Torna al pannello principale", callback_data="back_main")])
 
-    ids_page = ",".join(str(b.id) for b in bookings_page)
+    ids_page = ",".join(str(b.id) for b, _, _ in rows)
     keyboard.append([InlineKeyboardButton("🗑 Rimuovi queste prenotazioni", callback_data=f"confirm_remove_{ids_page}")])
 
     kb = InlineKeyboardMarkup(keyboard)
@@ -1813,20 +2543,30 @@ async def handle_remove_callback(update: Update, context: ContextTypes.DEFAULT_T
             ids_str = data.replace("confirm_remove_", "")
             booking_ids = [int(x) for x in ids_str.split(",")]
 
-            removed, not_found = [], []
-            for booking_id in booking_ids:
-                booking = session.query(Booking).get(booking_id)
-                if not booking:
-                    not_found.append(booking_id)
-                    continue
+            # 🔹 Rimozione logica in una sola transazione e con un numero fisso di query:
+            #    assegnazioni e storico restano (report e audit), le liste le saltano
+            now = datetime.now(timezone.utc)
+            removed = (await session.scalars(
+                sql_update(Booking)
+                .where(Booking.id.in_(booking_ids), BOOKING_NOT_DELETED)
+                .values(deleted_at=now)
+                .returning(Booking.id)
+                .execution_options(synchronize_session=False)
+            )).all()
+            removed = sorted(removed)
 
-                # Elimina assignment ed event log collegati
-                session.query(Assignment).filter_by(booking_id=booking.id).delete()
-                session.query(EventLog).filter_by(booking_id=booking.id).delete()
-                session.delete(booking)
-                removed.append(booking_id)
-
-            session.commit()
+            if removed:
+                # Niente più avvisi 48h per le prenotazioni rimosse
+                await session.execute(
+                    sql_update(Assignment)
+                    .where(Assignment.booking_id.in_(removed))
+                    .values(due_alert_sent=True)
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+            event_log.log_many(removed, update.effective_user.id, "remove")
+            removed_set = set(removed)
+            not_found = [bid for bid in booking_ids if bid not in removed_set]
 
             # Messaggio finale
             msg_parts = []
@@ -1862,268 +2602,381 @@ async def handle_remove_callback(update: Update, context: ContextTypes.DEFAULT_T
             )
 
     finally:
-        session.close()
+        await session.close()
+
+# ---- REPORT SETTIMANALE ----
+# 🔹 Un solo aggregato SQL: i sacramenti (stringa "a, b") vengono separati nel DB,
+#    il matrimonio è diviso in base/premium leggendo le note, e GROUPING SETS
+#    restituisce insieme totale, classifica sacerdoti, dettaglio e totali per sacramento.
+WEEKLY_STATS_SQL = text("""
+    WITH done AS (
+        SELECT b.id,
+               b.sacrament,
+               lower(coalesce(b.notes, '')) AS notes,
+               (SELECT a.priest_telegram_id FROM assignments a
+                 WHERE a.booking_id = b.id ORDER BY a.id LIMIT 1) AS pid
+        FROM bookings b
+        WHERE b.status = 'completed'
+          AND b.updated_at >= :start
+          AND b.updated_at <= :end
+    ), sacs AS (
+        SELECT d.id,
+               d.pid,
+               CASE
+                   WHEN lower(s.sac) = 'matrimonio' AND d.notes LIKE '%premium%' THEN 'matrimonio premium'
+                   WHEN lower(s.sac) = 'matrimonio' AND (d.notes LIKE '%base%' OR d.notes LIKE '%default%') THEN 'matrimonio base'
+                   ELSE s.sac
+               END AS sac
+        FROM done d
+        LEFT JOIN LATERAL (
+            SELECT nullif(trim(x), '') AS sac FROM unnest(string_to_array(d.sacrament, ',')) AS x
+        ) s ON true
+    )
+    SELECT GROUPING(pid) AS g_pid,
+           GROUPING(sac) AS g_sac,
+           pid,
+           sac,
+           count(DISTINCT id) AS bookings,
+           count(sac) AS n
+    FROM sacs
+    GROUP BY GROUPING SETS ((), (pid), (sac), (pid, sac))
+    ORDER BY n DESC, sac
+""")
+
+async def _weekly_stats(session, start, end):
+    rows = (await session.execute(WEEKLY_STATS_SQL, {"start": start, "end": end})).all()
+
+    total = 0
+    per_priest = {}
+    priest_sacraments = {}
+    per_sacrament = {}
+    for g_pid, g_sac, pid, sac, bookings, n in rows:
+        if g_pid and g_sac:
+            total = bookings
+        elif g_sac:
+            if pid:
+                per_priest[pid] = bookings
+        elif g_pid:
+            if sac:
+                per_sacrament[sac] = n
+        elif pid and sac:
+            priest_sacraments.setdefault(pid, {})[sac] = n
+
+    open_items = await session.scalar(select(func.count(Booking.id)).filter(
+        Booking.status.in_(["pending", "assigned", "in_progress"]),
+        BOOKING_NOT_DELETED
+    ))
 
-async def weekly_report(app):
+    return total, per_priest, priest_sacraments, per_sacrament, open_items
+
+async def _weekly_report_text(start, end, manual=False):
     session = SessionLocal()
     try:
-        now = datetime.now(timezone.utc)
-
-        # Inizio settimana (lunedì)
-        start = (now - timedelta(days=now.weekday())).replace(
-            hour=0, minute=0, second=0, microsecond=0
+        total, per_priest, priest_sacraments, per_sacrament, open_items = (
+            await _weekly_stats(session, start, end)
         )
-        # Fine settimana (domenica inclusa)
-        end = start + timedelta(days=6, hours=23, minutes=59, seconds=59)
-
-        # Prenotazioni completate nella settimana
-        completed = session.query(Booking).filter(
-            Booking.status == "completed",
-            Booking.updated_at >= start,
-            Booking.updated_at <= end
-        ).all()
-
-        total = len(completed)
-
-        per_priest = {}
-        priest_sacraments = {}
-
-        for b in completed:
-            a = session.query(Assignment).filter(
-                Assignment.booking_id == b.id
-            ).first()
-
-            pid = a.priest_telegram_id if a else None
-            if not pid:
-                continue
-
-            per_priest[pid] = per_priest.get(pid, 0) + 1
-
-            if b.sacrament:
-                sac_list = [s.strip() for s in b.sacrament.split(",")]
-                notes = (b.notes or "").lower()
-
-                if pid not in priest_sacraments:
-                    priest_sacraments[pid] = {}
-
-                for sac in sac_list:
-                    sac_key = sac
-
-                    # 🔹 MATRIMONIO BASE / PREMIUM
-                    if sac.lower() == "matrimonio":
-                        if "premium" in notes:
-                            sac_key = "matrimonio premium"
-                        elif "base" in notes or "default" in notes:
-                            sac_key = "matrimonio base"
+    finally:
+        await session.close()
 
-                    priest_sacraments[pid][sac_key] = priest_sacraments[pid].get(sac_key, 0) + 1
+    # 🔹 Username della classifica dalla directory in memoria
+    priests = await priest_directory.get_many(per_priest)
 
-        per_sacrament = {}
+    period = "in questo periodo" if manual else "questa settimana"
 
-        for b in completed:
-            if not b.sacrament:
-                continue
+    lines = [
+        "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️",
+        "",
+        "📊 <b>Report settimanale (manuale)</b>" if manual else "📊 <b>Report settimanale</b>",
+        f"🗓 Periodo: <b>{start.date()} ➝ {end.date()}</b>",
+        f"✝️ Totale sacramenti completati: <b>{total}</b>",
+        "",
+        "🏆 <b>Classifica sacerdoti:</b>"
+    ]
 
-            sac_list = [s.strip() for s in b.sacrament.split(",")]
-            notes = (b.notes or "").lower()
+    if per_priest:
+        for pid, num in sorted(per_priest.items(), key=lambda x: x[1], reverse=True):
+            priest = priests.get(pid)
+            priest_tag = f"@{priest.username}" if priest and priest.username else str(pid)
 
-            for sac in sac_list:
-                sac_key = sac
+            detail = []
+            for sac, count in priest_sacraments.get(pid, {}).items():
+                sac_name = sac.replace("_", " ")
+                if count > 1:
+                    detail.append(f"{sac_name} ({count})" if manual else f"{sac_name} ({count} volte)")
+                else:
+                    detail.append(sac_name)
 
-                # 🔹 MATRIMONIO BASE / PREMIUM
-                if sac.lower() == "matrimonio":
-                    if "premium" in notes:
-                        sac_key = "matrimonio premium"
-                    elif "base" in notes or "default" in notes:
-                        sac_key = "matrimonio base"
+            detail_str = ", ".join(detail) if detail else "Nessun sacramento registrato"
 
-                per_sacrament[sac_key] = per_sacrament.get(sac_key, 0) + 1
+            lines.append(f"- 🙏 Sacerdote <b>{priest_tag}</b>: {num} ➝ {detail_str}")
+    else:
+        lines.append(f"ℹ️ Nessun sacramento completato dai sacerdoti {period}.")
 
-        open_items = session.query(Booking).filter(
-            Booking.status.in_(["pending", "assigned", "in_progress"])
-        ).count()
+    lines.append("")
+    lines.append("✝️ <b>Dettaglio per sacramento (totale):</b>")
 
-        lines = [
-            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️",
-            "",
-            "📊 <b>Report settimanale</b>",
-            f"🗓 Periodo: <b>{start.date()} ➝ {end.date()}</b>",
-            f"✝️ Totale sacramenti completati: <b>{total}</b>",
-            "",
-            "🏆 <b>Classifica sacerdoti:</b>"
-        ]
+    if per_sacrament:
+        for sac, num in per_sacrament.items():
+            lines.append(f"- {sac.replace('_',' ')}: {num}")
+    else:
+        lines.append(f"ℹ️ Nessun sacramento completato {period}.")
 
-        if per_priest:
-            for pid, num in sorted(per_priest.items(), key=lambda x: x[1], reverse=True):
-                priest = session.query(Priest).filter(
-                    Priest.telegram_id == pid
-                ).first()
+    lines.append("")
+    lines.append(f"📌 Prenotazioni ancora <b>aperte</b>: {open_items}")
+    return "\n".join(lines)
 
-                priest_tag = f"@{priest.username}" if priest and priest.username else str(pid)
+async def weekly_report(app):
+    now = datetime.now(timezone.utc)
 
-                detail = []
-                if pid in priest_sacraments:
-                    for sac, count in priest_sacraments[pid].items():
-                        sac_name = sac.replace("_", " ")
-                        if count > 1:
-                            detail.append(f"{sac_name} ({count} volte)")
-                        else:
-                            detail.append(sac_name)
+    # Inizio settimana (lunedì)
+    start = (now - timedelta(days=now.weekday())).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    # Fine settimana (domenica inclusa)
+    end = start + timedelta(days=6, hours=23, minutes=59, seconds=59)
 
-                detail_str = ", ".join(detail) if detail else "Nessun sacramento registrato"
+    # Invio al gruppo direzione nel topic configurato
+    await app.bot.send_message(
+        DIRECTORS_GROUP_ID,
+        await _weekly_report_text(start, end),
+        parse_mode="HTML",
+        message_thread_id=12874
+    )
 
-                lines.append(f"- 🙏 Sacerdote <b>{priest_tag}</b>: {num} ➝ {detail_str}")
-        else:
-            lines.append("ℹ️ Nessun sacramento completato dai sacerdoti questa settimana.")
+async def manual_weekly_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 📌 Date fisse richieste: 23/03 → 29/03
+    start = datetime(2026, 3, 23, 0, 0, 0, tzinfo=timezone.utc)
+    end   = datetime(2026, 3, 29, 23, 59, 59, tzinfo=timezone.utc)
 
-        lines.append("")
-        lines.append("✝️ <b>Dettaglio per sacramento (totale):</b>")
+    # Invio al segretario che ha richiesto il comando
+    await update.message.reply_text(
+        await _weekly_report_text(start, end, manual=True),
+        parse_mode="HTML"
+    )
 
-        if per_sacrament:
-            for sac, num in per_sacrament.items():
-                lines.append(f"- {sac.replace('_',' ')}: {num}")
-        else:
-            lines.append("ℹ️ Nessun sacramento completato questa settimana.")
 
-        lines.append("")
-        lines.append(f"📌 Prenotazioni ancora <b>aperte</b>: {open_items}")
+# ---- ESPORTAZIONE ----
+EXPORT_BATCH = 1000   # righe per fetch dal cursore lato server
+EXPORT_FORMATS = ("csv", "jsonl")
 
-        # Invio al gruppo direzione nel topic configurato
-        await app.bot.send_message(
-            DIRECTORS_GROUP_ID,
-            "\n".join(lines),
-            parse_mode="HTML",
-            message_thread_id=12874
-        )
+EXPORT_BOOKING_COLUMNS = [
+    Booking.id, Booking.source, Booking.status, Booking.sacrament, Booking.rp_name, Booking.nickname_mc,
+    Booking.notes, Booking.client_telegram_id, Booking.secretary_username, Booking.created_at,
+    Booking.updated_at, Booking.deleted_at,
+    Assignment.priest_telegram_id, Assignment.priest_username, Assignment.assigned_by, Assignment.assigned_at,
+]
+EXPORT_EVENT_COLUMNS = [EventLog.id, EventLog.booking_id, EventLog.actor_id, EventLog.action, EventLog.ts, EventLog.details]
 
-    finally:
-        session.close()
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
 
-async def manual_weekly_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _stream_to(archive, name, fmt, stmt):
+    # 🔹 Cursore lato server (yield_per): in memoria c'è un solo blocco di righe alla volta
     session = SessionLocal()
     try:
-        # 📌 Date fisse richieste: 23/03 → 29/03
-        start = datetime(2026, 3, 23, 0, 0, 0, tzinfo=timezone.utc)
-        end   = datetime(2026, 3, 29, 23, 59, 59, tzinfo=timezone.utc)
-
-        # Prenotazioni completate nella settimana
-        completed = session.query(Booking).filter(
-            Booking.status == "completed",
-            Booking.updated_at >= start,
-            Booking.updated_at <= end
-        ).all()
-
-        total = len(completed)
-
-        per_priest = {}
-        priest_sacraments = {}
-
-        for b in completed:
-            a = session.query(Assignment).filter(
-                Assignment.booking_id == b.id
-            ).first()
-
-            pid = a.priest_telegram_id if a else None
-            if not pid:
-                continue
-
-            per_priest[pid] = per_priest.get(pid, 0) + 1
-
-            if b.sacrament:
-                sac_list = [s.strip() for s in b.sacrament.split(",")]
-                notes = (b.notes or "").lower()
-
-                if pid not in priest_sacraments:
-                    priest_sacraments[pid] = {}
-
-                for sac in sac_list:
-                    sac_key = sac
-
-                    # MATRIMONIO BASE / PREMIUM
-                    if sac.lower() == "matrimonio":
-                        if "premium" in notes:
-                            sac_key = "matrimonio premium"
-                        elif "base" in notes or "default" in notes:
-                            sac_key = "matrimonio base"
+        result = await session.stream(stmt.execution_options(yield_per=EXPORT_BATCH))
+        keys = list(result.keys())
+        with archive.open(f"{name}.{fmt}", "w") as raw:
+            out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            writer = csv.writer(out) if fmt == "csv" else None
+            if writer:
+                writer.writerow(keys)
+            count = 0
+            async for rows in result.partitions():
+                for row in rows:
+                    values = [_export_value(v) for v in row]
+                    if writer:
+                        writer.writerow(values)
+                    else:
+                        out.write(json.dumps(dict(zip(keys, values)), ensure_ascii=False) + "\n")
+                count += len(rows)
+            out.flush()
+            out.detach()
+        return count
+    finally:
+        await session.close()
 
-                    priest_sacraments[pid][sac_key] = priest_sacraments[pid].get(sac_key, 0) + 1
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def esporta(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != DIRECTORS_GROUP_ID:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Questo comando può essere usato <b>solo nel gruppo Direzione</b>.",
+            parse_mode="HTML"
+        )
+        return
 
-        per_sacrament = {}
+    fmt = (context.args[0].lower() if context.args else "csv")
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ Uso: <code>/esporta csv</code> oppure <code>/esporta jsonl</code>",
+            parse_mode="HTML",
+            message_thread_id=DIRECTORS_TOPIC_ID
+        )
+        return
 
-        for b in completed:
-            if not b.sacrament:
-                continue
+    bookings_stmt = (
+        select(*EXPORT_BOOKING_COLUMNS)
+        .outerjoin(Assignment, Assignment.booking_id == Booking.id)
+        .order_by(Booking.id)
+    )
+    events_stmt = select(*EXPORT_EVENT_COLUMNS).order_by(EventLog.id)
 
-            sac_list = [s.strip() for s in b.sacrament.split(",")]
-            notes = (b.notes or "").lower()
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M")
+    filename = f"export_{stamp}_{fmt}.zip"
+    await event_log.flush()   # anche gli eventi ancora in coda
 
-            for sac in sac_list:
-                sac_key = sac
+    # 🔹 File temporaneo su disco e un solo upload: memoria costante anche con anni di storico
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, filename)
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            n_bookings = await _stream_to(archive, "bookings", fmt, bookings_stmt)
+            n_events = await _stream_to(archive, "events_log", fmt, events_stmt)
 
-                if sac.lower() == "matrimonio":
-                    if "premium" in notes:
-                        sac_key = "matrimonio premium"
-                    elif "base" in notes or "default" in notes:
-                        sac_key = "matrimonio base"
+        with open(path, "rb") as document:
+            await context.bot.send_document(
+                DIRECTORS_GROUP_ID,
+                document=document,
+                filename=filename,
+                caption=f"📦 Esportazione {fmt.upper()}: {n_bookings} prenotazioni, {n_events} eventi.",
+                message_thread_id=DIRECTORS_TOPIC_ID
+            )
 
-                per_sacrament[sac_key] = per_sacrament.get(sac_key, 0) + 1
 
-        open_items = session.query(Booking).filter(
-            Booking.status.in_(["pending", "assigned", "in_progress"])
-        ).count()
+# ---- STORICO DI UNA PRENOTAZIONE ----
+TIMELINE_LIMIT = 50
 
-        # COSTRUZIONE MESSAGGIO
-        lines = [
-            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️",
-            "",
-            "📊 <b>Report settimanale (manuale)</b>",
-            f"🗓 Periodo: <b>{start.date()} ➝ {end.date()}</b>",
-            f"✝️ Totale sacramenti completati: <b>{total}</b>",
-            "",
-            "🏆 <b>Classifica sacerdoti:</b>"
-        ]
+TIMELINE_ICONS = {
+    "create": "🆕",
+    "assign": "📌",
+    "reassign": "🔄",
+    "complete": "✅",
+    "remove": "🗑",
+}
 
-        if per_priest:
-            for pid, num in sorted(per_priest.items(), key=lambda x: x[1], reverse=True):
-                priest = session.query(Priest).filter(
-                    Priest.telegram_id == pid
-                ).first()
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        booking_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ Uso: <code>/storico &lt;ID prenotazione&gt;</code>",
+            parse_mode="HTML"
+        )
+        return
 
-                priest_tag = f"@{priest.username}" if priest and priest.username else str(pid)
+    # 🔹 Gli eventi appena accodati devono comparire; la lettura usa l'indice (booking_id, ts)
+    await event_log.flush()
+    session = SessionLocal()
+    try:
+        events = (await session.execute(
+            select(EventLog.ts, EventLog.actor_id, EventLog.action, EventLog.details)
+            .where(EventLog.booking_id == booking_id)
+            .order_by(EventLog.ts, EventLog.id)
+            .limit(TIMELINE_LIMIT)
+        )).all()
+    finally:
+        await session.close()
 
-                detail = []
-                if pid in priest_sacraments:
-                    for sac, count in priest_sacraments[pid].items():
-                        sac_name = sac.replace("_", " ")
-                        detail.append(f"{sac_name} ({count})" if count > 1 else sac_name)
+    if not events:
+        await update.message.reply_text(
+            f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\nℹ️ Nessun evento registrato per la prenotazione #{booking_id}.",
+            parse_mode="HTML"
+        )
+        return
 
-                detail_str = ", ".join(detail) if detail else "Nessun sacramento registrato"
+    lines = [f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n🕓 Storico prenotazione #{booking_id}:\n"]
+    for ts, actor_id, action, details in events:
+        when = ts.strftime("%d/%m/%Y %H:%M") if ts else "-"
+        icon = TIMELINE_ICONS.get(action, "•")
+        extra = f" {html.escape(details)}" if details else ""
+        lines.append(f"{icon} {when} — <b>{html.escape(action or '')}</b>{extra} (da {actor_id})")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+# ---- GESTIONE RUOLI ----
+ROLE_LABELS = {
+    ROLE_PRIEST: "🙏 Sacerdoti",
+    ROLE_SECRETARY: "📖 Segretari",
+    ROLE_DIRECTOR: "👑 Direzione",
+}
+
+def _parse_role_args(args):
+    # 🔹 "<ID telegram> <ruolo>" (ruolo senza distinzione tra maiuscole e minuscole)
+    if len(args) < 2:
+        return None
+    try:
+        telegram_id = int(args[0])
+    except ValueError:
+        return None
+    role = args[1].lower()
+    return (telegram_id, role) if role in ROLES else None
 
-                lines.append(f"- 🙏 Sacerdote <b>{priest_tag}</b>: {num} ➝ {detail_str}")
-        else:
-            lines.append("ℹ️ Nessun sacramento completato dai sacerdoti in questo periodo.")
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def ruoli(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 🔹 Sempre la versione più recente, anche se modificata da un altro worker
+    await role_directory.refresh()
+    priests = await priest_directory.get_many(
+        tid for role in ROLES for tid in role_directory.members(role)
+    )
 
+    lines = ["<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️", "", "👥 <b>Ruoli dello staff</b>"]
+    for role in ROLES:
         lines.append("")
-        lines.append("✝️ <b>Dettaglio per sacramento (totale):</b>")
+        lines.append(f"{ROLE_LABELS[role]}:")
+        ids = sorted(role_directory.members(role))
+        if not ids:
+            lines.append("ℹ️ Nessuno.")
+        for tid in ids:
+            priest = priests.get(tid)
+            tag = f" (@{html.escape(priest.username)})" if priest and priest.username else ""
+            lines.append(f"- <code>{tid}</code>{tag}")
+    lines.append("")
+    lines.append("➡️ <code>/aggiungi_ruolo &lt;ID&gt; &lt;ruolo&gt;</code> · <code>/rimuovi_ruolo &lt;ID&gt; &lt;ruolo&gt;</code>")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
-        if per_sacrament:
-            for sac, num in per_sacrament.items():
-                lines.append(f"- {sac.replace('_',' ')}: {num}")
-        else:
-            lines.append("ℹ️ Nessun sacramento completato in questo periodo.")
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def aggiungi_ruolo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parsed = _parse_role_args(context.args)
+    if not parsed:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ Uso: <code>/aggiungi_ruolo &lt;ID telegram&gt; "
+            "sacerdote|segretario|direzione</code>",
+            parse_mode="HTML"
+        )
+        return
 
-        lines.append("")
-        lines.append(f"📌 Prenotazioni ancora <b>aperte</b>: {open_items}")
+    telegram_id, role = parsed
+    if await role_directory.add(telegram_id, role, update.effective_user.id):
+        text_msg = f"✅ Ruolo <b>{role}</b> assegnato a <code>{telegram_id}</code>."
+    else:
+        text_msg = f"ℹ️ <code>{telegram_id}</code> ha già il ruolo <b>{role}</b>."
+    await update.message.reply_text(f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n{text_msg}", parse_mode="HTML")
 
-        # Invio al segretario che ha richiesto il comando
+@role_required(is_director, "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non hai il permesso per eseguire questo comando.")
+async def rimuovi_ruolo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parsed = _parse_role_args(context.args)
+    if not parsed:
         await update.message.reply_text(
-            "\n".join(lines),
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n⚠️ Uso: <code>/rimuovi_ruolo &lt;ID telegram&gt; "
+            "sacerdote|segretario|direzione</code>",
             parse_mode="HTML"
         )
+        return
 
-    finally:
-        session.close()
+    telegram_id, role = parsed
+    # 🔒 Deve restare almeno un membro della Direzione, altrimenti nessuno potrebbe più gestire i ruoli
+    if role == ROLE_DIRECTOR and role_directory.members(ROLE_DIRECTOR) == {telegram_id}:
+        await update.message.reply_text(
+            "<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n❌ Non puoi rimuovere l'ultimo membro della <b>Direzione</b>.",
+            parse_mode="HTML"
+        )
+        return
 
+    if await role_directory.remove(telegram_id, role):
+        text_msg = f"✅ Ruolo <b>{role}</b> rimosso a <code>{telegram_id}</code>."
+    else:
+        text_msg = f"ℹ️ <code>{telegram_id}</code> non ha il ruolo <b>{role}</b>."
+    await update.message.reply_text(f"<b>𝐂𝐔𝐋𝐓𝐎 𝐃𝐈 𝐏𝐎𝐒𝐄𝐈𝐃𝐎𝐍𝐄</b> ⚓️\n\n{text_msg}", parse_mode="HTML")
 
 
 async def on_error(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2150,10 +3003,17 @@ async def get_topic_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---- BUILD APPLICATION ----
 def build_application():
-    # Inizializza DB
-    init_db()
-    # Costruisci l'applicazione Telegram
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Costruisci l'applicazione Telegram (il DB viene inizializzato all'avvio del loop)
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .rate_limiter(OutboundRateLimiter())   # 🔹 limiti Telegram globali e per chat
+        # 🔹 user_data e conversazioni sopravvivono ai riavvii (le migrazioni girano prima del caricamento)
+        .persistence(DBPersistence(engine, prepare=init_db))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_error_handler(on_error)
     # --- START & Ruoli ---
     app.add_handler(CommandHandler("start", start))
@@ -2170,12 +3030,20 @@ def build_application():
         },
         fallbacks=[CommandHandler("cancel", cancel_handler)],
         allow_reentry=True,
+        name="prenota_ingame",
+        persistent=True,
     )
     app.add_handler(conv_ingame)
     # --- Direzione ---
     app.add_handler(CommandHandler("riassegna", riassegna))  
     app.add_handler(CallbackQueryHandler(reassign_callback, pattern=r"^reassign_"))
     app.add_handler(CommandHandler("report_settimana", manual_weekly_report))
+    app.add_handler(CommandHandler("esporta", esporta))
+    app.add_handler(CommandHandler("storico", storico))
+    app.add_handler(CommandHandler("ruoli", ruoli))
+    app.add_handler(CommandHandler("aggiungi_ruolo", aggiungi_ruolo))
+    app.add_handler(CommandHandler("rimuovi_ruolo", rimuovi_ruolo))
+    app.add_handler(CommandHandler("auto_assegna", auto_assegna))
 
     app.add_handler(CommandHandler("lista_prenotazioni", lista_prenotazioni))
     app.add_handler(CallbackQueryHandler(handle_remove_callback, pattern=r"^(confirm_remove_|cancel_remove)"))
@@ -2199,4 +3067,7 @@ def build_application():
     app.add_handler(CallbackQueryHandler(completa_booking, pattern=r"^completa_\d+$"))
     app.add_handler(CallbackQueryHandler(back_menu, pattern=r"^back_menu$"))
 
+    # 🔹 Latenza per handler, ritardo degli update e code (esposti su /metrics)
+    metrics.instrument_application(app)
+
     return app
@@ -0,0 +1,331 @@
+# ---- BENCHMARK HANDLER ----
+# Uso (serve un Postgres locale DEDICATO: lo schema public viene ricreato a ogni taglia):
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/chiesa_bench python bench.py --bookings 10000 100000 1000000
+#
+# Per ogni taglia genera dati deterministici (--seed), poi chiama gli handler con
+# Update/Bot finti e riporta latenza p50/p95/p99 e numero di query per chiamata.
+import os
+import sys
+import random
+import asyncio
+import argparse
+from time import perf_counter
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+if not BENCH_DATABASE_URL:
+    sys.exit("BENCH_DATABASE_URL non impostato (usa un database dedicato: viene svuotato!)")
+
+# 🔹 app.py legge l'ambiente all'import: impostiamo valori finti PRIMA di importarlo
+BENCH_DIRECTORS_GROUP_ID = -1000000000001
+BENCH_DIRECTOR_ID = 1
+BENCH_PRIESTS = 40
+BENCH_PRIEST_BASE_ID = 10_000
+os.environ["DATABASE_URL"] = BENCH_DATABASE_URL
+os.environ["DIRECTORS_GROUP_ID"] = str(BENCH_DIRECTORS_GROUP_ID)
+os.environ["DIRECTORS_TOPIC_ID"] = "1"
+os.environ["DIRECTORS_IDS"] = str(BENCH_DIRECTOR_ID)
+os.environ["PRIESTS_IDS"] = ",".join(str(BENCH_PRIEST_BASE_ID + i) for i in range(BENCH_PRIESTS))
+os.environ.setdefault("SECRETARIES_IDS", str(BENCH_PRIEST_BASE_ID))
+
+import logging
+
+from sqlalchemy import insert, text
+from telegram import Update, CallbackQuery, Message, Chat, User
+
+import app
+from app import (
+    engine, init_db, priest_directory, role_directory,
+    Booking, Assignment, EventLog, Priest, SACRAMENTS,
+)
+from migrations import MIGRATIONS
+from metrics import query_profile
+
+logging.getLogger("app").setLevel(logging.WARNING)
+logging.getLogger("migrations").setLevel(logging.WARNING)
+
+INSERT_CHUNK = 10_000
+
+# Distribuzione degli stati (somma 1.0)
+STATUS_WEIGHTS = {
+    "pending": 0.10,
+    "assigned": 0.15,
+    "in_progress": 0.05,
+    "completed": 0.65,
+    "canceled": 0.05,
+}
+
+
+# ---- GENERATORE DATI ----
+def _sacrament(rng):
+    picked = rng.sample(SACRAMENTS, rng.choice((1, 1, 1, 2, 3)))
+    return ",".join(picked)
+
+def generate_rows(n_bookings, seed):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    statuses = list(STATUS_WEIGHTS)
+    weights = list(STATUS_WEIGHTS.values())
+    priest_ids = [BENCH_PRIEST_BASE_ID + i for i in range(BENCH_PRIESTS)]
+
+    priests = [
+        {"telegram_id": pid, "username": f"sacerdote_{i}", "created_at": now - timedelta(days=400)}
+        for i, pid in enumerate(priest_ids)
+    ]
+
+    bookings, assignments, events = [], [], []
+    for booking_id in range(1, n_bookings + 1):
+        status = rng.choices(statuses, weights)[0]
+        created_at = now - timedelta(minutes=rng.randrange(365 * 24 * 60))
+        updated_at = min(now, created_at + timedelta(minutes=rng.randrange(7 * 24 * 60)))
+        notes = rng.choice(("no", "premium", "base", "rito all'alba", ""))
+        bookings.append({
+            "id": booking_id,
+            "source": "ingame",
+            "client_telegram_id": 1_000_000 + rng.randrange(n_bookings),
+            "rp_name": f"Fedele {rng.randrange(n_bookings)}",
+            "nickname_mc": f"player_{rng.randrange(n_bookings)}",
+            "sacrament": _sacrament(rng),
+            "notes": notes,
+            "status": status,
+            "secretary_username": "segretario",
+            "created_at": created_at,
+            "updated_at": updated_at,
+        })
+        events.append({"booking_id": booking_id, "actor_id": 2, "action": "create", "ts": created_at, "details": None})
+
+        if status in ("pending", "canceled"):
+            continue
+        priest_id = rng.choice(priest_ids)
+        assigned_at = created_at + (updated_at - created_at) / 2
+        assignments.append({
+            "booking_id": booking_id,
+            "priest_telegram_id": priest_id,
+            "priest_username": f"sacerdote_{priest_id - BENCH_PRIEST_BASE_ID}",
+            "assigned_by": BENCH_DIRECTOR_ID,
+            "assigned_at": assigned_at,
+            "due_alert_sent": status != "assigned",
+        })
+        events.append({"booking_id": booking_id, "actor_id": BENCH_DIRECTOR_ID, "action": "assign",
+                       "ts": assigned_at, "details": f"to @sacerdote_{priest_id - BENCH_PRIEST_BASE_ID}"})
+        if status == "completed":
+            events.append({"booking_id": booking_id, "actor_id": priest_id, "action": "complete",
+                           "ts": updated_at, "details": None})
+
+    return priests, bookings, assignments, events
+
+
+async def reset_schema():
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP SCHEMA public CASCADE"))
+        await conn.execute(text("CREATE SCHEMA public"))
+    await init_db()
+
+
+async def seed(n_bookings, seed_value):
+    priests, bookings, assignments, events = generate_rows(n_bookings, seed_value)
+    async with engine.begin() as conn:
+        for table, rows in (
+            (Priest.__table__, priests),
+            (Booking.__table__, bookings),
+            (Assignment.__table__, assignments),
+            (EventLog.__table__, events),
+        ):
+            for i in range(0, len(rows), INSERT_CHUNK):
+                await conn.execute(insert(table), rows[i:i + INSERT_CHUNK])
+        # Gli id espliciti non fanno avanzare la sequenza
+        await conn.execute(text("SELECT setval('bookings_id_seq', (SELECT max(id) FROM bookings))"))
+        # Contatori settimanali: stessa ricostruzione della migrazione
+        for version, _, steps in MIGRATIONS:
+            if version == 6:
+                for step in steps:
+                    if step.startswith("INSERT"):
+                        await conn.execute(text(step))
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM ANALYZE"))
+
+    pending_ids = [b["id"] for b in bookings if b["status"] == "pending"]
+    return pending_ids, len(assignments), len(events)
+
+
+# ---- STUB TELEGRAM ----
+class StubBot:
+    # Registra le chiamate senza rete; restituisce un message_id come l'API vera
+    def __init__(self):
+        self.calls = 0
+        self.last_markup = None
+
+    async def _call(self, *args, reply_markup=None, **kwargs):
+        self.calls += 1
+        if reply_markup is not None:
+            self.last_markup = reply_markup
+        return SimpleNamespace(message_id=self.calls)
+
+    send_message = _call
+    delete_message = _call
+    edit_message_text = _call
+    edit_message_reply_markup = _call
+    answer_callback_query = _call
+
+
+# 🔹 Oggetti PTB veri (isinstance nei rendering) collegati al bot finto
+_update_ids = iter(range(1, 10**9))
+
+def _user(user_id):
+    return User(id=user_id, first_name=f"u{user_id}", is_bot=False, username=f"u{user_id}")
+
+def _message(bot, chat_id, user, text=None):
+    chat = Chat(id=chat_id, type=Chat.SUPERGROUP if chat_id < 0 else Chat.PRIVATE)
+    message = Message(message_id=1, date=datetime.now(timezone.utc), chat=chat, from_user=user, text=text)
+    message.set_bot(bot)
+    return message
+
+def callback_update(bot, user_id, chat_id, data):
+    user = _user(user_id)
+    query = CallbackQuery(id="1", from_user=user, chat_instance="1", data=data,
+                          message=_message(bot, chat_id, user))
+    query.set_bot(bot)
+    return Update(update_id=next(_update_ids), callback_query=query)
+
+def command_update(bot, user_id, chat_id, text="/cmd"):
+    return Update(update_id=next(_update_ids), message=_message(bot, chat_id, _user(user_id), text))
+
+def make_context(bot, args=None):
+    return SimpleNamespace(bot=bot, user_data={}, chat_data={}, args=args or [])
+
+def next_page_data(markup):
+    if markup is None:
+        return None
+    for row in markup.inline_keyboard:
+        for button in row:
+            if (button.callback_data or "").startswith("bookings_page_") and "_n" in button.callback_data:
+                return button.callback_data
+    return None
+
+
+# ---- SCENARI ----
+def build_scenarios(bot, rng, pending_ids):
+    director_chat = BENCH_DIRECTORS_GROUP_ID
+    priest_ids = [BENCH_PRIEST_BASE_ID + i for i in range(BENCH_PRIESTS)]
+
+    async def paginated_status():
+        last_list = {"kind": "status", "status": "completed", "title": "bench"}
+        await app._send_paginated_bookings(callback_update(bot, BENCH_DIRECTOR_ID, director_chat, "x").callback_query, last_list)
+
+    async def lista_filter_assigned():
+        await app.lista_prenotazioni_callback(
+            callback_update(bot, BENCH_DIRECTOR_ID, director_chat, "filter_assigned"), make_context(bot))
+
+    async def lista_next_page():
+        context = make_context(bot)
+        await app.lista_prenotazioni_callback(
+            callback_update(bot, BENCH_DIRECTOR_ID, director_chat, "filter_completed"), context)
+        data = next_page_data(bot.last_markup)
+        if data:
+            await app.lista_prenotazioni_callback(callback_update(bot, BENCH_DIRECTOR_ID, director_chat, data), context)
+
+    async def lista_priest():
+        pid = rng.choice(priest_ids)
+        await app.lista_prenotazioni_callback(
+            callback_update(bot, BENCH_DIRECTOR_ID, director_chat, f"priest_{pid}"), make_context(bot))
+
+    async def mie_assegnazioni():
+        pid = rng.choice(priest_ids)
+        await app.mie_assegnazioni(command_update(bot, pid, pid), make_context(bot))
+
+    async def assign_menu():
+        booking_id = rng.choice(pending_ids) if pending_ids else 1
+        await app.assign_callback(
+            callback_update(bot, BENCH_DIRECTOR_ID, director_chat, f"assign_{booking_id}"), make_context(bot))
+
+    async def weekly_report():
+        await app.weekly_report(SimpleNamespace(bot=bot))
+
+    return [
+        ("_send_paginated_bookings", paginated_status),
+        ("lista filter_assigned", lista_filter_assigned),
+        ("lista pagina successiva", lista_next_page),
+        ("lista per sacerdote", lista_priest),
+        ("mie_assegnazioni", mie_assegnazioni),
+        ("assign_callback", assign_menu),
+        ("weekly_report", weekly_report),
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+async def run_scenario(name, fn, bot, iterations, warmup, max_queries=None):
+    for _ in range(warmup):
+        await fn()
+    timings, queries, sql_ms = [], [], []
+    for _ in range(iterations):
+        calls = bot.calls
+        # 🔹 Stesso profilo usato in produzione: con --max-queries fallisce alla prima query di troppo
+        with query_profile(name, max_queries=max_queries, strict=max_queries is not None) as profile:
+            t0 = perf_counter()
+            await fn()
+            timings.append((perf_counter() - t0) * 1000)
+        # 🔹 Un handler che esce prima di rispondere (controllo di tipo o permesso fallito)
+        #    misurerebbe il nulla: lo scenario deve arrivare almeno a una chiamata al bot
+        if bot.calls == calls:
+            raise RuntimeError(f"Lo scenario {name!r} non ha inviato nulla al bot: risultati non validi")
+        queries.append(profile.queries)
+        sql_ms.append(profile.sql_seconds * 1000)
+    timings.sort()
+    return {
+        "p50": percentile(timings, 50),
+        "p95": percentile(timings, 95),
+        "p99": percentile(timings, 99),
+        "queries": sum(queries) / len(queries),
+        "sql_ms": sum(sql_ms) / len(sql_ms),
+    }
+
+
+async def bench_size(n_bookings, args):
+    print(f"\n== {n_bookings:,} prenotazioni ==")
+    t0 = perf_counter()
+    await reset_schema()
+    pending_ids, n_assign, n_events = await seed(n_bookings, args.seed)
+    priest_directory.invalidate()
+    await role_directory.load()   # ruoli dalle variabili d'ambiente del benchmark
+    print(f"dati generati in {perf_counter() - t0:.1f}s ({n_assign:,} assegnazioni, {n_events:,} eventi)")
+
+    bot = StubBot()
+    rng = random.Random(args.seed)
+    print(f"{'scenario':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'query':>8}{'SQL ms':>10}")
+    for name, fn in build_scenarios(bot, rng, pending_ids):
+        if args.only and name not in args.only:
+            continue
+        r = await run_scenario(name, fn, bot, args.iterations, args.warmup, args.max_queries)
+        print(f"{name:<28}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}{r['queries']:>8.1f}{r['sql_ms']:>10.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark handler su dati sintetici")
+    parser.add_argument("--bookings", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", nargs="*", help="esegui solo gli scenari indicati")
+    parser.add_argument("--max-queries", type=int, help="modalità stretta: errore se uno scenario supera N query")
+    args = parser.parse_args()
+
+    try:
+        for n in args.bookings:
+            await bench_size(n, args)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from time import monotonic, perf_counter
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import TELEGRAM_API_SECONDS, TELEGRAM_API_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# ---- LIMITI TELEGRAM ----
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = (30, 1)          # 30 richieste al secondo in totale
+PRIVATE_CHAT_RATE = (1, 1)     # ~1 messaggio al secondo per chat privata
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = (20, 60)     # 20 messaggi al minuto per gruppo (Direzione compresa)
+GROUP_CHAT_BURST = 5
+MAX_RETRIES = 3
+MAX_CHAT_BUCKETS = 1000
+
+# Metodi che non devono aspettare nessun limite (long polling / configurazione)
+UNLIMITED_ENDPOINTS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "setMyCommands", "close", "logOut"}
+
+
+class TokenBucket:
+    def __init__(self, rate, per, burst=None):
+        self.capacity = burst or rate
+        self.tokens = float(self.capacity)
+        self.fill_rate = rate / per
+        self.updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        # 🔹 Il lock rende l'attesa FIFO: chi arriva prima parte prima
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # 🔹 Applicato da PTB a ogni chiamata del bot (ApplicationBuilder().rate_limiter()):
+    #    i messaggi indipendenti possono partire insieme senza sforare i limiti di Telegram.
+    #    - limite globale su tutte le richieste
+    #    - limite per chat sugli invii (i gruppi, es. DIRECTORS_GROUP_ID, sono più stretti)
+    #    - su RetryAfter tutte le richieste si fermano per il tempo indicato, poi si riprova
+    def __init__(self, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        self._global = TokenBucket(*GLOBAL_RATE)
+        self._chats = {}
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                # Scarta i bucket pieni: si ricreano identici al prossimo invio
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(*GROUP_CHAT_RATE, burst=GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(*PRIVATE_CHAT_RATE, burst=PRIVATE_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _wait_pause(self):
+        delay = self._paused_until - monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _timed_call(self, callback, args, kwargs, endpoint):
+        t0 = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as exc:
+            TELEGRAM_API_ERRORS.inc(endpoint, type(exc).__name__)
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(perf_counter() - t0, endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            # getUpdates resta fuori dalle metriche: il long polling durerebbe sempre ~timeout
+            return await callback(*args, **kwargs)
+
+        chat_id = data.get("chat_id")
+        # Solo gli invii consumano il limite per chat: modifiche e callback restano veloci
+        chat_bucket = None
+        if chat_id is not None and (endpoint.startswith("send") or endpoint in ("copyMessage", "forwardMessage")):
+            chat_bucket = self._chat_bucket(chat_id)
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_pause()
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await self._timed_call(callback, args, kwargs, endpoint)
+            except RetryAfter as exc:
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = float(exc.retry_after)
+                logger.warning("RetryAfter %.1fs su %s (chat %s), tentativo %s",
+                               retry_after, endpoint, chat_id, attempt + 1)
+                self._paused_until = max(self._paused_until, monotonic() + retry_after)
+
+
+async def send_all(*calls):
+    # 🔹 Invia notifiche indipendenti in parallelo (il limiter le distribuisce nel tempo).
+    #    Un invio fallito non blocca gli altri: viene solo registrato nel log.
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Invio Telegram fallito: %s", result)
+    return [None if isinstance(r, Exception) else r for r in results]
@@ -1,9 +1,22 @@
 import os
+import hmac
+import json
+import signal
+import logging
+import asyncio
 import threading
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response
 from datetime import time
-from app import build_application, weekly_report
+import tornado.web
+from tornado.wsgi import WSGIContainer
+from telegram import Update
+from app import build_application, weekly_report, sweep_uncompleted, UNCOMPLETED_SWEEP_INTERVAL
 import pytz
+import metrics
+
+logger = logging.getLogger(__name__)
+
 # --- Flask web server ---
 flask_app = Flask(__name__)
 
@@ -11,8 +24,20 @@ flask_app = Flask(__name__)
 def home():
     return "Bot is running!"
 
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 ROME_TZ = pytz.timezone("Europe/Rome")
 
+# --- Webhook (se WEBHOOK_URL è impostato, altrimenti polling) ---
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")            # es. https://bot.example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")      # obbligatorio: verificato sull'header di Telegram
+# ⚠️ Senza segreto chiunque raggiunga l'URL potrebbe inviare update falsi con l'ID di un direttore
+#    (i controlli di ruolo guardano solo effective_user.id): in quel caso si resta in polling.
+#    Il webhook richiede un dyno "web" (vedi Procfile): i dyno "worker" non ricevono traffico HTTP.
+
 def schedule_jobs(application):
     application.job_queue.run_daily(
         weekly_report,
@@ -20,11 +45,76 @@ def schedule_jobs(application):
         days=(1,),  # 0 = lunedì
         name="weekly_report_job"
     )
+    # 🔹 Avvisi 48h: un solo job periodico che legge le scadenze dal DB
+    application.job_queue.run_repeating(
+        sweep_uncompleted,
+        interval=UNCOMPLETED_SWEEP_INTERVAL,
+        first=60,
+        name="uncompleted_sweeper_job"
+    )
 
 def run_flask():
     port = int(os.environ.get("PORT", 5000))
     flask_app.run(host="0.0.0.0", port=port, use_reloader=False)
 
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app):
+        self.bot_app = bot_app
+
+    async def post(self):
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+        # 🔹 L'update entra nella stessa coda usata dal polling
+        await self.bot_app.update_queue.put(Update.de_json(data, self.bot_app.bot))
+        self.set_status(200)
+
+
+async def run_webhook(app):
+    # 🔹 Un solo server asincrono sul loop del bot: webhook Telegram + rotte Flask
+    #    (health check e future rotte) servite tramite WSGIContainer
+    port = int(os.environ.get("PORT", 5000))
+    web_app = tornado.web.Application([
+        (rf"/{WEBHOOK_PATH}", TelegramWebhookHandler, {"bot_app": app}),
+        (r".*", tornado.web.FallbackHandler, {
+            "fallback": WSGIContainer(flask_app, executor=ThreadPoolExecutor(max_workers=2)),
+        }),
+    ])
+    server = web_app.listen(port, address="0.0.0.0")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # Stessi hook di run_polling (post_init / post_stop / post_shutdown)
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        await app.start()
+
+        await stop_event.wait()
+
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        server.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
 if __name__ == "__main__":
     # Costruisci l'applicazione Telegram
     app = build_application()
@@ -32,8 +122,15 @@ if __name__ == "__main__":
     # Pianifica i job settimanali
     schedule_jobs(app)
 
-    # Avvia Flask in un thread separato (per UptimeRobot)
-    threading.Thread(target=run_flask).start()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_URL impostato ma WEBHOOK_SECRET mancante: webhook disattivato, avvio in polling")
+
+    if WEBHOOK_URL and WEBHOOK_SECRET:
+        # Avvia il bot in modalità webhook (un solo server, nessun thread Flask)
+        asyncio.run(run_webhook(app))
+    else:
+        # Avvia Flask in un thread separato (per UptimeRobot)
+        threading.Thread(target=run_flask).start()
 
-    # Avvia il bot in modalità polling
-    app.run_polling(drop_pending_updates=True)
+        # Avvia il bot in modalità polling
+        app.run_polling(drop_pending_updates=True)
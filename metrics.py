@@ -0,0 +1,300 @@
+import os
+import logging
+import functools
+import threading
+from collections import Counter as _TallyCounter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from bisect import bisect_left
+from datetime import datetime, timezone
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# ---- REGISTRO ----
+# Formato testo di Prometheus (https://prometheus.io/docs/instrumenting/exposition_formats/).
+# Ogni metrica ha il suo lock: gli handler scrivono dal loop del bot, /metrics legge dal thread Flask.
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels_text(self.labelnames, labels)} {value}"
+
+
+class Gauge(_Metric):
+    # 🔹 Valore letto al momento dello scrape tramite una funzione (nessun costo a runtime)
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        super().__init__(name, help_text)
+        self.fn = fn
+
+    def _samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        yield f"{self.name} {value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if idx < len(self.buckets):
+                state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels_text(self.labelnames, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_bucket{_labels_text(self.labelnames, labels, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_sum{_labels_text(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels_text(self.labelnames, labels)} {count}"
+
+
+def render():
+    lines = []
+    for metric in list(REGISTRY):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- METRICHE DEL BOT ----
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Durata degli handler Telegram", ("handler", "pattern"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Eccezioni sollevate dagli handler", ("handler", "pattern"))
+UPDATE_LAG_SECONDS = Histogram(
+    "bot_update_lag_seconds", "Ritardo tra l'invio del messaggio e la sua elaborazione",
+    buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+TELEGRAM_API_SECONDS = Histogram("telegram_api_seconds", "Durata delle chiamate all'API Telegram", ("endpoint",))
+TELEGRAM_API_ERRORS = Counter("telegram_api_errors_total", "Errori delle chiamate all'API Telegram", ("endpoint", "error"))
+DB_QUERIES = Counter("db_queries_total", "Statement SQL eseguiti")
+HANDLER_QUERIES = Histogram(
+    "bot_handler_queries", "Statement SQL eseguiti per singolo update", ("handler",),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55),
+)
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Connessioni prese dal pool")
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds", "Attesa per ottenere una connessione dal pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+
+
+# ---- PROFILO PER UPDATE ----
+# 🔹 Ogni statement SQL viene attribuito all'update/handler in corso tramite una ContextVar
+#    (SQLAlchemy la propaga nel greenlet che esegue gli eventi dell'engine).
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "10"))                          # query per update
+LATENCY_BUDGET = float(os.getenv("HANDLER_LATENCY_BUDGET", "1.0"))           # secondi
+STRICT_QUERY_BUDGET = os.getenv("QUERY_BUDGET_STRICT", "") == "1"            # solleva invece di loggare
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryProfile:
+    def __init__(self, label, max_queries=None, strict=False):
+        self.label = label
+        self.max_queries = max_queries
+        self.strict = strict
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = _TallyCounter()
+
+    def before_statement(self, statement):
+        self.queries += 1
+        self.statements[statement] += 1
+        if self.strict and self.max_queries is not None and self.queries > self.max_queries:
+            raise QueryBudgetExceeded(
+                f"{self.label}: {self.queries} query oltre il limite di {self.max_queries}\n{statement}"
+            )
+
+    def most_repeated(self):
+        # Lo statement ripetuto più spesso: di solito è il ciclo N+1
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+
+_current_profile = ContextVar("query_profile", default=None)
+
+
+@contextmanager
+def query_profile(label, max_queries=None, strict=False):
+    # 🔹 Uso nei test: with query_profile("lista", max_queries=3, strict=True): await handler(...)
+    profile = QueryProfile(label, max_queries=max_queries, strict=strict)
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+
+
+def _check_budget(profile, elapsed, update_id=None):
+    over_queries = profile.max_queries is not None and profile.queries > profile.max_queries
+    if not over_queries and elapsed <= LATENCY_BUDGET:
+        return
+    statement, repeats = profile.most_repeated()
+    logger.warning(
+        "Handler %s oltre il budget (update %s): %.0f ms, %s query, %.0f ms di SQL. "
+        "Statement più ripetuto (%sx): %s",
+        profile.label, update_id, elapsed * 1000, profile.queries, profile.sql_seconds * 1000,
+        repeats, (statement or "-")[:200],
+    )
+
+
+# ---- DATABASE ----
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # 🔹 Misura quanto si aspetta una connessione libera (o la creazione di una nuova)
+    def _do_get(self):
+        t0 = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(perf_counter() - t0)
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc()
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.before_statement(statement)
+            conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _time_query(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        starts = conn.info.get("query_start")
+        if profile is not None and starts:
+            profile.sql_seconds += perf_counter() - starts.pop()
+
+    @event.listens_for(sync_engine.pool, "checkout")
+    def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKOUTS.inc()
+
+    pool = sync_engine.pool
+    Gauge("db_pool_checked_out", "Connessioni attualmente in uso", pool.checkedout)
+    Gauge("db_pool_overflow", "Connessioni oltre la dimensione del pool", pool.overflow)
+
+
+# ---- HANDLER ----
+def _handler_label(handler):
+    pattern = getattr(handler, "pattern", None)
+    if pattern is not None:
+        return getattr(pattern, "pattern", str(pattern))
+    commands = getattr(handler, "commands", None)
+    if commands:
+        return "/" + ",".join(sorted(commands))
+    return ""
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument_handler(inner)
+        return
+
+    callback = handler.callback
+    labels = (callback.__name__, _handler_label(handler))
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        t0 = perf_counter()
+        with query_profile(callback.__name__, max_queries=QUERY_BUDGET, strict=STRICT_QUERY_BUDGET) as profile:
+            try:
+                return await callback(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(*labels)
+                raise
+            finally:
+                elapsed = perf_counter() - t0
+                HANDLER_SECONDS.observe(elapsed, *labels)
+                HANDLER_QUERIES.observe(profile.queries, callback.__name__)
+                _check_budget(profile, elapsed, getattr(update, "update_id", None))
+
+    handler.callback = timed
+
+
+async def _observe_update_lag(update, context):
+    # Solo i messaggi nuovi hanno una data affidabile (i callback portano quella del messaggio originale)
+    message = update.message or update.edited_message
+    if message and message.date:
+        UPDATE_LAG_SECONDS.observe(max((datetime.now(timezone.utc) - message.date).total_seconds(), 0))
+
+
+def instrument_application(app):
+    # 🔹 Da chiamare dopo aver registrato tutti gli handler
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+    app.add_handler(TypeHandler(Update, _observe_update_lag), group=-1)
+
+    Gauge("bot_update_queue_size", "Update in coda non ancora elaborati", app.update_queue.qsize)
+    if app.job_queue:
+        Gauge("bot_job_queue_jobs", "Job pianificati nella JobQueue", lambda: len(app.job_queue.jobs()))
@@ -0,0 +1,191 @@
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# 🔹 Chiave del lock consultivo: un solo processo alla volta applica le migrazioni
+MIGRATIONS_LOCK_KEY = 7_420_001
+
+
+# Tabelle dello schema iniziale: le tabelle aggiunte dopo nascono SOLO nella loro migrazione
+# (con i DEFAULT lato DB che le scritture in SQL puro si aspettano)
+BASELINE_TABLES = ("users", "bookings", "assignments", "events_log", "priests")
+
+
+def _create_all(conn, metadata):
+    # Crea solo le tabelle mancanti (DB nuovo o installazioni precedenti al versionamento)
+    metadata.create_all(conn, tables=[metadata.tables[name] for name in BASELINE_TABLES])
+
+
+# ---- MIGRAZIONI ----
+# Ogni voce è (versione, descrizione, passi). Un passo è una stringa SQL oppure
+# una funzione fn(conn, metadata) eseguita in modalità sincrona.
+# ⚠️ I passi devono essere idempotenti (IF NOT EXISTS / checkfirst): su un DB nuovo
+# la versione 1 crea le tabelle iniziali con le colonne del modello attuale
+# (per questo gli ADD COLUMN usano IF NOT EXISTS).
+MIGRATIONS = [
+    (1, "schema iniziale", [_create_all]),
+    (2, "indici sulle colonne di filtro", [
+        "CREATE INDEX IF NOT EXISTS ix_bookings_status_id ON bookings (status, id)",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_status_updated_at ON bookings (status, updated_at)",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_open ON bookings (status, id) "
+        "WHERE status IN ('pending', 'assigned', 'in_progress')",
+        "CREATE INDEX IF NOT EXISTS ix_assignments_booking_id ON assignments (booking_id)",
+        "CREATE INDEX IF NOT EXISTS ix_assignments_priest_booking ON assignments (priest_telegram_id, booking_id)",
+        "CREATE INDEX IF NOT EXISTS ix_events_log_booking_id ON events_log (booking_id)",
+    ]),
+    (3, "messaggio Direzione salvato sulla prenotazione", [
+        "ALTER TABLE bookings ADD COLUMN IF NOT EXISTS directors_message_id BIGINT",
+    ]),
+    (4, "scadenze 48h lette dal DB", [
+        # Le assegnazioni già chiuse non devono generare avvisi né stare nell'indice; quelle
+        # oltre le 48h hanno già avuto l'avviso dal vecchio controllo (non va ripetuto a tutto l'arretrato)
+        "UPDATE assignments a SET due_alert_sent = "
+        "(b.status <> 'assigned' OR a.assigned_at <= now() - interval '48 hours') "
+        "FROM bookings b WHERE b.id = a.booking_id AND a.due_alert_sent IS NOT TRUE",
+        "UPDATE assignments SET due_alert_sent = true WHERE due_alert_sent IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_assignments_due ON assignments (assigned_at) "
+        "WHERE due_alert_sent = false",
+    ]),
+    (5, "rimozione logica delle prenotazioni", [
+        "ALTER TABLE bookings ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+        # Le liste filtrano sempre su deleted_at IS NULL: indici parziali sulle sole righe visibili
+        "DROP INDEX IF EXISTS ix_bookings_open",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_open ON bookings (status, id) "
+        "WHERE status IN ('pending', 'assigned', 'in_progress') AND deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_live_status_id ON bookings (status, id) "
+        "WHERE deleted_at IS NULL",
+        "DROP INDEX IF EXISTS ix_bookings_status_id",
+    ]),
+    (6, "contatori settimanali per sacerdote", [
+        "CREATE TABLE IF NOT EXISTS priest_workload ("
+        " priest_telegram_id BIGINT NOT NULL,"
+        " iso_year INTEGER NOT NULL,"
+        " iso_week INTEGER NOT NULL,"
+        " assigned_count INTEGER NOT NULL DEFAULT 0,"
+        " completed_count INTEGER NOT NULL DEFAULT 0,"
+        " PRIMARY KEY (priest_telegram_id, iso_year, iso_week))",
+        # Ricostruzione dallo storico: assegnazioni correnti e completamenti registrati
+        # (entrambi i contatori espliciti: la tabella potrebbe non avere i DEFAULT lato DB)
+        "INSERT INTO priest_workload (priest_telegram_id, iso_year, iso_week, assigned_count, completed_count) "
+        "SELECT priest_telegram_id, extract(isoyear FROM assigned_at)::int, extract(week FROM assigned_at)::int, count(*), 0 "
+        "FROM assignments WHERE priest_telegram_id IS NOT NULL AND assigned_at IS NOT NULL "
+        "GROUP BY 1, 2, 3 "
+        "ON CONFLICT (priest_telegram_id, iso_year, iso_week) DO UPDATE SET assigned_count = EXCLUDED.assigned_count",
+        "INSERT INTO priest_workload (priest_telegram_id, iso_year, iso_week, assigned_count, completed_count) "
+        "SELECT actor_id, extract(isoyear FROM ts)::int, extract(week FROM ts)::int, 0, count(*) "
+        "FROM events_log WHERE action = 'complete' AND actor_id IS NOT NULL AND ts IS NOT NULL "
+        "GROUP BY 1, 2, 3 "
+        "ON CONFLICT (priest_telegram_id, iso_year, iso_week) DO UPDATE SET completed_count = EXCLUDED.completed_count",
+    ]),
+    (7, "ricerca fedele con trigrammi", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        # % (somiglianza) e ILIKE '%...%' usano gli indici GIN; il prefisso usa text_pattern_ops
+        "CREATE INDEX IF NOT EXISTS ix_bookings_nickname_trgm ON bookings "
+        "USING gin (nickname_mc gin_trgm_ops) WHERE deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_rp_name_trgm ON bookings "
+        "USING gin (rp_name gin_trgm_ops) WHERE deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_bookings_nickname_prefix ON bookings "
+        "(lower(nickname_mc) text_pattern_ops) WHERE deleted_at IS NULL",
+    ]),
+    (8, "stato del bot persistente (user_data e conversazioni)", [
+        "CREATE TABLE IF NOT EXISTS bot_state ("
+        " kind VARCHAR NOT NULL,"
+        " key VARCHAR NOT NULL,"
+        " data JSONB NOT NULL,"
+        " updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),"
+        " PRIMARY KEY (kind, key))",
+    ]),
+    (9, "storico per prenotazione ordinato nel tempo", [
+        "CREATE INDEX IF NOT EXISTS ix_events_log_booking_ts ON events_log (booking_id, ts)",
+        # Coperto dal nuovo indice (stesso prefisso)
+        "DROP INDEX IF EXISTS ix_events_log_booking_id",
+    ]),
+    (10, "outbox delle notifiche Telegram", [
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        " id BIGSERIAL PRIMARY KEY,"
+        " idempotency_key VARCHAR NOT NULL UNIQUE,"
+        " method VARCHAR NOT NULL,"
+        " payload JSONB NOT NULL,"
+        " booking_id INTEGER,"
+        " on_sent VARCHAR,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " last_error VARCHAR,"
+        " created_at TIMESTAMPTZ NOT NULL DEFAULT now(),"
+        " next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),"
+        " sent_at TIMESTAMPTZ,"
+        " failed_at TIMESTAMPTZ)",
+        # Il worker legge solo i messaggi ancora da consegnare
+        "CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (next_attempt_at, id) "
+        "WHERE sent_at IS NULL AND failed_at IS NULL",
+    ]),
+    (11, "ruoli dello staff nel database", [
+        "CREATE TABLE IF NOT EXISTS staff_roles ("
+        " telegram_id BIGINT NOT NULL,"
+        " role VARCHAR NOT NULL,"
+        " added_by BIGINT,"
+        " added_at TIMESTAMPTZ DEFAULT now(),"
+        " PRIMARY KEY (telegram_id, role))",
+        "CREATE TABLE IF NOT EXISTS directory_versions ("
+        " name VARCHAR PRIMARY KEY,"
+        " version BIGINT NOT NULL DEFAULT 0)",
+        # La tabella resta vuota: al primo avvio RoleDirectory la riempie da SECRETARIES_IDS / PRIESTS_IDS / DIRECTORS_IDS
+    ]),
+    (12, "assegnazione automatica", [
+        "CREATE TABLE IF NOT EXISTS bot_settings ("
+        " key VARCHAR PRIMARY KEY,"
+        " value VARCHAR NOT NULL,"
+        " updated_by BIGINT,"
+        " updated_at TIMESTAMPTZ DEFAULT now())",
+        # Carico aperto per sacerdote: join dalle sole prenotazioni assegnate/in corso
+        "CREATE INDEX IF NOT EXISTS ix_bookings_open_assigned ON bookings (id) "
+        "WHERE status IN ('assigned', 'in_progress') AND deleted_at IS NULL",
+    ]),
+    (13, "token di presa in carico della outbox", [
+        # Il worker che ha preso un messaggio lo rinnova e lo chiude solo se il token è ancora il suo
+        "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS claim_token UUID",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def _current_version(conn):
+    return await conn.scalar(text("SELECT coalesce(max(version), 0) FROM schema_migrations"))
+
+
+async def apply_migrations(engine, metadata):
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY,"
+            " description VARCHAR,"
+            " applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        ))
+
+        # 🔹 Avvio normale: una sola lettura e nessuna riflessione dello schema
+        current = await _current_version(conn)
+        if current >= LATEST_VERSION:
+            return current
+
+        # 🔹 Più worker in avvio: il primo applica, gli altri attendono e rileggono
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        current = await _current_version(conn)
+
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in steps:
+                if callable(step):
+                    await conn.run_sync(step, metadata)
+                else:
+                    await conn.execute(text(step))
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description},
+            )
+            logger.info("Migrazione %s applicata: %s", version, description)
+            current = version
+
+        return current
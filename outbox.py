@@ -0,0 +1,212 @@
+import json
+import asyncio
+import logging
+from time import monotonic
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+# ---- OUTBOX NOTIFICHE ----
+OUTBOX_POLL_INTERVAL = 5       # secondi tra due controlli se nessuno sveglia il worker
+OUTBOX_BATCH = 50              # messaggi presi per giro
+OUTBOX_LEASE = 60              # secondi: un messaggio preso non viene ripreso da altri worker
+OUTBOX_LEASE_RENEW = 20        # secondi: finché il blocco è in invio il worker rinnova la lease
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5        # secondi, raddoppia a ogni tentativo
+OUTBOX_BACKOFF_MAX = 30 * 60
+OUTBOX_RETENTION_DAYS = 7      # i messaggi chiusi più vecchi vengono eliminati
+OUTBOX_PURGE_INTERVAL = 60 * 60
+
+# Errori che un nuovo tentativo non risolve (chat bloccata, messaggio non più modificabile…)
+PERMANENT_ERRORS = (Forbidden, BadRequest)
+
+# Azioni dopo l'invio riuscito
+ON_SENT_DIRECTORS_MESSAGE = "directors_message"   # salva message_id su bookings.directors_message_id
+
+OUTBOX_SENT = Counter("outbox_sent_total", "Notifiche consegnate dalla outbox", ("method",))
+OUTBOX_RETRIES = Counter("outbox_retries_total", "Notifiche da ritentare", ("method", "error"))
+OUTBOX_FAILED = Counter("outbox_failed_total", "Notifiche scartate dopo errori definitivi o troppi tentativi", ("method",))
+
+ENQUEUE_SQL = text(
+    "INSERT INTO outbox (idempotency_key, method, payload, booking_id, on_sent) "
+    "VALUES (:key, :method, CAST(:payload AS jsonb), :booking_id, :on_sent) "
+    "ON CONFLICT (idempotency_key) DO NOTHING"
+)
+
+CLAIM_SQL = text(
+    "UPDATE outbox SET next_attempt_at = now() + make_interval(secs => :lease), claim_token = CAST(:token AS uuid) "
+    "WHERE id IN ("
+    " SELECT id FROM outbox"
+    " WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= now()"
+    " ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED) "
+    "RETURNING id, method, payload, booking_id, on_sent, attempts"
+)
+
+RENEW_SQL = text(
+    "UPDATE outbox SET next_attempt_at = now() + make_interval(secs => :lease) "
+    "WHERE claim_token = CAST(:token AS uuid) AND sent_at IS NULL AND failed_at IS NULL"
+)
+
+
+async def enqueue(session, key, method, booking_id=None, on_sent=None, **kwargs):
+    # 🔹 Scrive la notifica nella transazione del chiamante: parte solo se il commit riesce.
+    #    La chiave di idempotenza scarta i duplicati (stesso update elaborato due volte, doppio click…)
+    markup = kwargs.get("reply_markup")
+    if isinstance(markup, InlineKeyboardMarkup):
+        kwargs["reply_markup"] = markup.to_dict()
+    await session.execute(ENQUEUE_SQL, {
+        "key": key,
+        "method": method,
+        "payload": json.dumps(kwargs),
+        "booking_id": booking_id,
+        "on_sent": on_sent,
+    })
+
+
+def _backoff(attempts):
+    return min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+
+
+class OutboxWorker:
+    # 🔹 Svuota la tabella outbox: prende un blocco di messaggi scaduti (SKIP LOCKED + lease,
+    #    quindi più worker non si pestano i piedi), li invia insieme tramite il rate limiter
+    #    e registra l'esito con un solo UPDATE per tipo. Gli errori temporanei vengono ritentati
+    #    con backoff esponenziale, quelli definitivi chiudono il messaggio.
+    #    Un blocco diretto a un solo gruppo può restare nel rate limiter per minuti: la lease
+    #    viene rinnovata finché l'invio è in corso e l'esito si scrive solo col proprio token.
+    def __init__(self, engine, poll_interval=OUTBOX_POLL_INTERVAL, batch_size=OUTBOX_BATCH):
+        self._engine = engine
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._bot = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._purged_at = monotonic()
+
+    def notify(self):
+        # Gli handler chiamano notify() dopo il commit: l'invio parte subito, senza aspettare il giro
+        self._wakeup.set()
+
+    async def _claim(self, token):
+        async with self._engine.begin() as conn:
+            result = await conn.execute(CLAIM_SQL, {"lease": OUTBOX_LEASE, "limit": self._batch_size, "token": token})
+            return sorted(result.all(), key=lambda row: row.id)
+
+    async def _renew(self, token):
+        # Se il worker muore il rinnovo si ferma e alla scadenza della lease un altro riprende i messaggi
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE_RENEW)
+            try:
+                async with self._engine.begin() as conn:
+                    await conn.execute(RENEW_SQL, {"lease": OUTBOX_LEASE, "token": token})
+            except Exception:
+                logger.warning("Rinnovo della lease outbox fallito, nuovo tentativo tra %ss", OUTBOX_LEASE_RENEW)
+
+    async def _send(self, row):
+        kwargs = row.payload if isinstance(row.payload, dict) else json.loads(row.payload)
+        if kwargs.get("reply_markup") is not None:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], self._bot)
+        return await getattr(self._bot, row.method)(**kwargs)
+
+    async def drain_once(self):
+        token = str(uuid4())
+        rows = await self._claim(token)
+        if not rows:
+            return 0
+
+        renew = asyncio.create_task(self._renew(token))
+        try:
+            results = await asyncio.gather(*(self._send(row) for row in rows), return_exceptions=True)
+        finally:
+            renew.cancel()
+
+        sent, retry, failed, message_ids = [], [], [], []
+        now = datetime.now(timezone.utc)
+        for row, result in zip(rows, results):
+            if not isinstance(result, Exception):
+                sent.append({"id": row.id})
+                OUTBOX_SENT.inc(row.method)
+                if row.on_sent == ON_SENT_DIRECTORS_MESSAGE and row.booking_id and hasattr(result, "message_id"):
+                    message_ids.append({"booking_id": row.booking_id, "message_id": result.message_id})
+                continue
+
+            attempts = row.attempts + 1
+            error = f"{type(result).__name__}: {result}"[:500]
+            if isinstance(result, PERMANENT_ERRORS) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.warning("Notifica %s scartata dopo %s tentativi: %s", row.id, attempts, error)
+                failed.append({"id": row.id, "token": token, "attempts": attempts, "error": error})
+                OUTBOX_FAILED.inc(row.method)
+            else:
+                retry.append({
+                    "id": row.id,
+                    "token": token,
+                    "attempts": attempts,
+                    "error": error,
+                    "next_attempt_at": now + timedelta(seconds=_backoff(attempts)),
+                })
+                OUTBOX_RETRIES.inc(row.method, type(result).__name__)
+
+        async with self._engine.begin() as conn:
+            # Consegnato resta consegnato anche se nel frattempo la presa è passata a un altro worker
+            if sent:
+                await conn.execute(text("UPDATE outbox SET sent_at = now() WHERE id = :id AND sent_at IS NULL"), sent)
+            # Tentativi ed errori invece valgono solo per chi ha ancora il messaggio in carico
+            if retry:
+                await conn.execute(text(
+                    "UPDATE outbox SET attempts = :attempts, last_error = :error, next_attempt_at = :next_attempt_at "
+                    "WHERE id = :id AND claim_token = CAST(:token AS uuid)"
+                ), retry)
+            if failed:
+                await conn.execute(text(
+                    "UPDATE outbox SET attempts = :attempts, last_error = :error, failed_at = now() "
+                    "WHERE id = :id AND claim_token = CAST(:token AS uuid)"
+                ), failed)
+            if message_ids:
+                await conn.execute(text(
+                    "UPDATE bookings SET directors_message_id = :message_id WHERE id = :booking_id"
+                ), message_ids)
+        return len(rows)
+
+    async def _purge(self):
+        async with self._engine.begin() as conn:
+            await conn.execute(text(
+                "DELETE FROM outbox WHERE coalesce(sent_at, failed_at) < now() - make_interval(days => :days)"
+            ), {"days": OUTBOX_RETENTION_DAYS})
+        self._purged_at = monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # Blocco pieno: probabilmente c'è altro in coda, si continua senza attendere
+                while await self.drain_once() >= self._batch_size:
+                    pass
+                if monotonic() - self._purged_at >= OUTBOX_PURGE_INTERVAL:
+                    await self._purge()
+            except Exception:
+                logger.exception("Invio notifiche dalla outbox fallito, nuovo tentativo al prossimo giro")
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,128 @@
+import json
+import asyncio
+import logging
+
+from sqlalchemy import text
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# 🔹 Ogni quanti secondi PTB consegna i dati modificati (user_data / conversazioni)
+PERSISTENCE_FLUSH_INTERVAL = 5
+
+USER_DATA = "user_data"
+CONVERSATION = "conversation:"   # + nome del ConversationHandler
+
+
+class DBPersistence(BasePersistence):
+    # 🔹 Stato di PTB salvato nella tabella bot_state (kind, key, data JSON).
+    #    Scrittura ritardata: gli update_* accumulano le modifiche in memoria e un solo
+    #    task le scrive tutte insieme (un upsert + un delete), quindi un click non costa
+    #    una scrittura. flush() (allo spegnimento) svuota il buffer.
+    def __init__(self, engine, prepare=None, update_interval=PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._engine = engine
+        self._prepare = prepare        # es. le migrazioni: la tabella deve esistere prima del caricamento
+        self._rows = None              # {(kind, key): data} letto all'avvio
+        self._dirty = {}               # {(kind, key): json oppure None = da eliminare}
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    async def _load(self):
+        if self._rows is None:
+            if self._prepare:
+                await self._prepare()
+            async with self._engine.connect() as conn:
+                # data::text: psycopg decodificherebbe già il JSONB, così il formato letto è sempre lo stesso
+                result = await conn.execute(text("SELECT kind, key, data::text FROM bot_state"))
+                self._rows = {(kind, key): json.loads(data) for kind, key, data in result}
+        return self._rows
+
+    # ---- scrittura ritardata ----
+    def _mark(self, kind, key, data):
+        self._dirty[(kind, key)] = None if data is None else json.dumps(data, default=str)
+        if self._flush_task is None or self._flush_task.done():
+            # PTB chiama gli update_* insieme: il task parte quando li ha ricevuti tutti
+            self._flush_task = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self):
+        async with self._write_lock:
+            dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            upserts = [{"kind": k, "key": key, "data": data} for (k, key), data in dirty.items() if data is not None]
+            deletes = [{"kind": k, "key": key} for (k, key), data in dirty.items() if data is None]
+            try:
+                async with self._engine.begin() as conn:
+                    if upserts:
+                        await conn.execute(text(
+                            "INSERT INTO bot_state (kind, key, data, updated_at) "
+                            "VALUES (:kind, :key, CAST(:data AS jsonb), now()) "
+                            "ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = now()"
+                        ), upserts)
+                    if deletes:
+                        await conn.execute(text("DELETE FROM bot_state WHERE kind = :kind AND key = :key"), deletes)
+            except Exception:
+                # Rimette in coda quello che non è stato scritto (senza coprire modifiche più recenti)
+                logger.exception("Salvataggio stato del bot fallito, nuovo tentativo al prossimo giro")
+                for item, data in dirty.items():
+                    self._dirty.setdefault(item, data)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+
+    # ---- user_data ----
+    async def get_user_data(self):
+        rows = await self._load()
+        return {int(key): data for (kind, key), data in rows.items() if kind == USER_DATA}
+
+    async def update_user_data(self, user_id, data):
+        self._mark(USER_DATA, str(user_id), data)
+
+    async def drop_user_data(self, user_id):
+        self._mark(USER_DATA, str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    # ---- conversazioni ----
+    async def get_conversations(self, name):
+        rows = await self._load()
+        kind = CONVERSATION + name
+        return {tuple(json.loads(key)): state for (k, key), state in rows.items() if k == kind}
+
+    async def update_conversation(self, name, key, new_state):
+        self._mark(CONVERSATION + name, json.dumps(list(key)), new_state)
+
+    # ---- non salvati (store_data li esclude) ----
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
@@ -0,0 +1,42 @@
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from migrations import MIGRATIONS
+from persistence import DBPersistence
+
+BOT_STATE_DDL = next(steps for version, _, steps in MIGRATIONS if version == 8)
+
+
+async def _reset_bot_state(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS bot_state"))
+        for step in BOT_STATE_DDL:
+            await conn.execute(text(step))
+
+
+def test_user_data_and_conversations_survive_restart(database_url):
+    async def scenario():
+        engine = create_async_engine(database_url)
+        try:
+            await _reset_bot_state(engine)
+
+            first = DBPersistence(engine)
+            await first.get_user_data()
+            await first.update_user_data(42, {"ingame_active": True, "sacraments": ["battesimo"]})
+            await first.update_conversation("prenota_ingame", (42, 42), 3)
+            await first.flush()
+
+            # Nuova istanza = riavvio del bot: i dati arrivano dal DB
+            second = DBPersistence(engine)
+            assert await second.get_user_data() == {42: {"ingame_active": True, "sacraments": ["battesimo"]}}
+            assert await second.get_conversations("prenota_ingame") == {(42, 42): 3}
+
+            await second.drop_user_data(42)
+            await second.flush()
+            assert await DBPersistence(engine).get_user_data() == {}
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())